@@ -11,33 +11,38 @@ Version 0.5.1 (2017-12-31)
 $Id$
 """
 
+import re
 import sys
+import mmap
 import time
 import ctypes
+import struct
 import typing
 
-from _sendkeys import key_up, key_down, toggle_numlock
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
 
-from threading import Lock
+from queue import PriorityQueue
+from threading import Lock, Thread, local
 
-from ctypes import c_uint8, c_int, c_uint, c_short, WinDLL, create_unicode_buffer, POINTER
-from ctypes.wintypes import WORD, DWORD, LPWSTR, WCHAR, LONG
+if typing.TYPE_CHECKING:
+    from concurrent.futures import Future
 
-__all__ = ['KeySequenceError', 'SendKeys']
+from ctypes import c_uint8, c_int, c_uint, c_short, create_unicode_buffer, POINTER
+from ctypes.wintypes import WORD, DWORD, BOOL, LPWSTR, LPCWSTR, WCHAR, LONG, HKL, HWND, LPDWORD
 
-user32 = WinDLL('user32', use_last_error=True)
+__all__ = ['KeySequenceError', 'Layout', 'LayoutCache', 'layout_cache', 'LayoutRegistry', 'layout_registry',
+           'KeyProgram', 'KeyRepeat', 'KeyEvents', 'KeyEvent', 'ProgramCache', 'optimize_keys', 'program_cache', 'compile_keys', 'iter_keys',
+           'Backend', 'User32Backend', 'RecordingBackend', 'default_backend', 'playkeys', 'aplaykeys',
+           'KeySession', 'SendKeys', 'async_send_keys', 'Dispatcher', 'dispatcher', 'submit_keys',
+           'serve', 'KeyClient', 'Metrics', 'enable_metrics', 'disable_metrics']
 
 ULONG_PTR = POINTER(DWORD)
 
 
-class KEYBDINPUT(ctypes.Structure):
-    _fields_ = (('wVk', WORD),
-                ('wScan', WORD),
-                ('dwFlags', DWORD),
-                ('time', DWORD),
-                ('dwExtraInfo', ULONG_PTR))
-
-
 # Included for completeness.
 class MOUSEINPUT(ctypes.Structure):
     _fields_ = (('dx', LONG),
@@ -72,39 +77,154 @@ class INPUT(ctypes.Structure):
     _fields_ = (('type', DWORD),
                 ('union', _INPUTunion))
 
-MapVirtualKey = user32.MapVirtualKeyW
-MapVirtualKey.argtypes = [c_uint, c_uint]
-MapVirtualKey.restype = c_uint
-
 keyboard_state_type = c_uint8 * 256
 
-ToUnicode = user32.ToUnicode
-ToUnicode.argtypes = [c_uint, c_uint, keyboard_state_type, LPWSTR, c_int, c_uint]
-ToUnicode.restype = c_int
+# the ``user32`` functions we use: name -> (argtypes, restype)
+_USER32_PROTOTYPES = {
+    'MapVirtualKeyW': ([c_uint, c_uint], c_uint),
+    'ToUnicode': ([c_uint, c_uint, keyboard_state_type, LPWSTR, c_int, c_uint], c_int),
+    'VkKeyScanW': ([WCHAR], c_short),
+    'MapVirtualKeyExW': ([c_uint, c_uint, HKL], c_uint),
+    'ToUnicodeEx': ([c_uint, c_uint, keyboard_state_type, LPWSTR, c_int, c_uint, HKL], c_int),
+    'VkKeyScanExW': ([WCHAR, HKL], c_short),
+    'GetForegroundWindow': ([], HWND),
+    'GetWindowThreadProcessId': ([HWND, LPDWORD], DWORD),
+    'GetKeyboardLayout': ([DWORD], HKL),
+    'SendInput': ([c_uint, POINTER(INPUT), c_int], c_uint),
+    'LoadKeyboardLayoutW': ([LPCWSTR, c_uint], HKL),
+    'UnloadKeyboardLayout': ([HKL], BOOL),
+    'GetKeyboardLayoutList': ([c_int, POINTER(HKL)], c_int),
+}
+
+# module attributes bound on first access, see `__getattr__`
+_LAZY_USER32_FUNCTIONS = {
+    'MapVirtualKey': 'MapVirtualKeyW',
+    'ToUnicode': 'ToUnicode',
+    'VkKeyScan': 'VkKeyScanW',
+    'MapVirtualKeyEx': 'MapVirtualKeyExW',
+    'ToUnicodeEx': 'ToUnicodeEx',
+    'VkKeyScanEx': 'VkKeyScanExW',
+    'GetForegroundWindow': 'GetForegroundWindow',
+    'GetWindowThreadProcessId': 'GetWindowThreadProcessId',
+    'GetKeyboardLayout': 'GetKeyboardLayout',
+    'SendInput': 'SendInput',
+    'LoadKeyboardLayout': 'LoadKeyboardLayoutW',
+    'UnloadKeyboardLayout': 'UnloadKeyboardLayout',
+    'GetKeyboardLayoutList': 'GetKeyboardLayoutList',
+}
+_LAZY_SENDKEYS_FUNCTIONS = ('key_up', 'key_down', 'toggle_numlock')
+
+_user32 = None
+
+
+def _load_user32():
+    """
+    Loads ``user32`` and declares the prototypes of the functions we use,
+    on first call only: parsing keys doesn't need it, and the module can
+    be imported where it doesn't exist.
+    """
+    global _user32
+    if _user32 is None:
+        from ctypes import WinDLL
+
+        dll = WinDLL('user32', use_last_error=True)
+        for name, (argtypes, restype) in _USER32_PROTOTYPES.items():
+            function = getattr(dll, name)
+            function.argtypes = argtypes
+            function.restype = restype
+        _user32 = dll
+    return _user32
+
+
+_kernel32 = None
+
+
+def _load_kernel32():
+    """
+    Loads ``kernel32``, only needed to resolve locale names, on first call.
+    """
+    global _kernel32
+    if _kernel32 is None:
+        from ctypes import WinDLL
+
+        dll = WinDLL('kernel32', use_last_error=True)
+        dll.LocaleNameToLCID.argtypes = [LPCWSTR, DWORD]
+        dll.LocaleNameToLCID.restype = DWORD
+        _kernel32 = dll
+    return _kernel32
+
+
+def _load_sendkeys():
+    """
+    Imports the ``_sendkeys`` extension on first call.
+    """
+    import _sendkeys
+    return _sendkeys
+
 
-VkKeyScan = user32.VkKeyScanW
-VkKeyScan.argtypes = [WCHAR]
-VkKeyScan.restype = c_short
+def __getattr__(name):
+    if name == 'user32':
+        return _load_user32()
+    if name == '_sendkeys':
+        return _load_sendkeys()
+    if name in _LAZY_USER32_FUNCTIONS:
+        return getattr(_load_user32(), _LAZY_USER32_FUNCTIONS[name])
+    if name in _LAZY_SENDKEYS_FUNCTIONS:
+        return getattr(_load_sendkeys(), name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
 
-SendInput = user32.SendInput
-SendInput.argtypes = [c_uint, POINTER(INPUT), c_int]
-SendInput.restype = c_uint
 
+KEYEVENTF_EXTENDEDKEY = 0x01
 KEYEVENTF_KEYUP = 0x02
 KEYEVENTF_UNICODE = 0x04
 
 INPUT_KEYBOARD = 1
 
+# native UTF-16, as expected by `KEYEVENTF_UNICODE`
+_UTF16 = 'utf-16-le' if sys.byteorder == 'little' else 'utf-16-be'
+
 USER32_MAPVK_VK_TO_VSC = 0
 USER32_MAPVK_VSC_TO_VK = 1
+USER32_MAPVK_VSC_TO_VK_EX = 3
 
 VK_SHIFT = 0x10
 VK_CONTROL = 0x11
 VK_MENU = 0x12
 ALT_GR = 0xA5  # RIGHT_MENU
+VK_NUMLOCK = 0x90
 
 PAUSE = 50 / 1000.0  # 50 milliseconds
 
+# keys whose release doesn't end a key combination
+MODIFIER_KEYS = frozenset((
+    VK_SHIFT, VK_CONTROL, VK_MENU,
+    0xA0, 0xA1,  # LSHIFT, RSHIFT
+    0xA2, 0xA3,  # LCONTROL, RCONTROL
+    0xA4, ALT_GR,  # LMENU, RMENU
+    0x5B, 0x5C,  # LWIN, RWIN
+))
+
+# keys sent with `KEYEVENTF_EXTENDEDKEY`
+EXTENDED_KEYS = frozenset((
+    0x03,  # CANCEL
+    0x21, 0x22, 0x23, 0x24,  # PRIOR, NEXT, END, HOME
+    0x25, 0x26, 0x27, 0x28,  # LEFT, UP, RIGHT, DOWN
+    0x2C, 0x2D, 0x2E,  # SNAPSHOT, INSERT, DELETE
+    0x5B, 0x5C, 0x5D,  # LWIN, RWIN, APPS
+    0x6F,  # DIVIDE
+    VK_NUMLOCK,
+    0xA3, ALT_GR,  # RCONTROL, RMENU
+)) | frozenset(range(0xA6, 0xB8))  # browser, volume, media and launch keys
+
+# maximum number of events sent in a single `SendInput` call
+MAX_BATCH_SIZE = 256
+
+# the `Scheduler` busy-waits for the last 2 milliseconds of a pause
+SPIN_THRESHOLD = 2 / 1000.0
+
+# number of characters `iter_keys` reads at once from a file
+STREAM_CHUNK_SIZE = 64 * 1024
+
 # imported from 'WinUser.h'
 CODES = {
     "LBUTTON": 0x01,
@@ -200,7 +320,7 @@ CODES = {
     "F22": 0x85,
     "F23": 0x86,
     "F24": 0x87,
-    "NUMLOCK": 0x90,
+    "NUMLOCK": VK_NUMLOCK,
     "SCROLL": 0x91,
     "OEM_NEC_EQUAL": 0x92,  # '=' key on numpad
     "OEM_FJ_JISHO": 0x92,  # 'Dictionary' key
@@ -281,23 +401,256 @@ PAUSE_CMD = "PAUSE="
 
 
 class VirtualKey:
+    """
+    A key resolved against a `Layout`: its virtual key `code`, `scancode`,
+    whether it is an `extended` key and the `Layout` flags of the modifiers
+    typing it requires.
+
+    It compares and hashes as its `code`, so that parsed keys still compare
+    equal to ``(vk, down)`` 2-tuples.
+    """
+
     __slots__ = (
         "code",
-        "shift",
-        "altgr",
+        "scancode",
         "extended",
+        "flags",
         "keypad"
     )
 
-    def __init__(self, code: int,
-                 shift: bool, altgr: bool,
-                 extended: bool, keypad: bool):
+    def __init__(self, code: int, scancode: int=0,
+                 extended: bool=False, flags: int=0,
+                 keypad: bool=False):
         self.code = code
-        self.shift = shift
-        self.altgr = altgr
+        self.scancode = scancode
         self.extended = extended
+        self.flags = flags
         self.keypad = keypad
 
+    @property
+    def shift(self) -> bool:
+        return bool(self.flags & Layout.REQUIRES_SHIFT)
+
+    @property
+    def altgr(self) -> bool:
+        return bool(self.flags & Layout.REQUIRES_ALT_GR)
+
+    def __index__(self):
+        return self.code
+
+    __int__ = __index__
+
+    def __eq__(self, other):
+        if type(other) is VirtualKey:
+            return self.code == other.code
+        return self.code == other
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return 'VirtualKey({:#04x}, scancode={:#04x})'.format(self.code, self.scancode)
+
+
+class _PackedTable(Mapping):
+    """
+    Read-only ``int -> int`` mapping over two parallel arrays, the keys
+    being sorted. Used to look up layout snapshots in place.
+    """
+
+    __slots__ = (
+        "_keys",
+        "_values"
+    )
+
+    def __init__(self, keys, values):
+        self._keys = keys
+        self._values = values
+
+    def _index(self, key):
+        if type(key) is int:
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                return i
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        return self._values[self._index(key)]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class _PackedCharTable(_PackedTable):
+    """
+    Read-only ``char -> (scancode, flags)`` mapping, keyed by code point.
+    """
+
+    __slots__ = (
+        "_flags",
+    )
+
+    def __init__(self, keys, values, flags):
+        super().__init__(keys, values)
+        self._flags = flags
+
+    def __getitem__(self, key):
+        if type(key) is not str or len(key) != 1:
+            raise KeyError(key)
+        i = self._index(ord(key))
+        return self._values[i], self._flags[i]
+
+    def __iter__(self):
+        return map(chr, self._keys)
+
+
+PhaseStats = namedtuple('PhaseStats', ('count', 'total', 'max'))
+HitRate = namedtuple('HitRate', ('hits', 'misses', 'rate'))
+MetricsReport = namedtuple('MetricsReport', ('phases', 'events', 'events_per_second',
+                                             'batch_sizes', 'lateness', 'caches'))
+
+# upper bounds, in seconds, of the buckets of the lateness histogram
+LATENESS_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05, float('inf'))
+
+
+class Metrics:
+    """
+    Opt-in instrumentation of the layouts, the parsing and the playback,
+    see `enable_metrics`.
+
+    It times the phases (``layout``, ``parse``, ``inject``, ``pause``,
+    ``playback``; a lazy layout scanned while parsing counts in both
+    ``layout`` and ``parse``), counts the events sent per batch, histograms the
+    lateness of the pauses (see `LATENESS_BUCKETS`) and counts the
+    hits and misses of the layout and program caches.
+
+    The hooks, if set, are called from the thread doing the work:
+
+    - ``on_parse(source, events, seconds)`` after a string of keys has
+      been parsed into `events` events;
+    - ``on_batch(events, seconds)`` after each batch of events has been
+      sent to the backend;
+    - ``on_pause(seconds, lateness)`` after each wait of the playback.
+
+    While metrics are enabled, `playkeys` plays the keys from Python even
+    on a native backend (see `Backend.play_packed`), whose batches and
+    waits can't be observed.
+    """
+
+    __slots__ = (
+        "on_parse",
+        "on_batch",
+        "on_pause",
+        "_phases",
+        "_events",
+        "_batch_sizes",
+        "_lateness",
+        "_caches",
+        "lock"
+    )
+
+    def __init__(self, on_parse=None, on_batch=None, on_pause=None):
+        self.on_parse = on_parse
+        self.on_batch = on_batch
+        self.on_pause = on_pause
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._phases = {}  # name -> [count, total, max]
+            self._events = 0
+            self._batch_sizes = {}
+            self._lateness = [0] * len(LATENESS_BUCKETS)
+            self._caches = {}  # name -> [hits, misses]
+
+    def phase(self, name, seconds):
+        with self.lock:
+            stats = self._phases.get(name)
+            if stats is None:
+                stats = self._phases[name] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+    def cache(self, name, hit):
+        with self.lock:
+            stats = self._caches.get(name)
+            if stats is None:
+                stats = self._caches[name] = [0, 0]
+            stats[0 if hit else 1] += 1
+
+    def parsed(self, source, events, seconds):
+        self.phase('parse', seconds)
+        if self.on_parse is not None:
+            self.on_parse(source, events, seconds)
+
+    def batch(self, events, seconds):
+        self.phase('inject', seconds)
+        with self.lock:
+            self._events += events
+            self._batch_sizes[events] = self._batch_sizes.get(events, 0) + 1
+        if self.on_batch is not None:
+            self.on_batch(events, seconds)
+
+    def paused(self, seconds, lateness):
+        self.phase('pause', seconds + lateness)
+        with self.lock:
+            self._lateness[bisect_left(LATENESS_BUCKETS, lateness)] += 1
+        if self.on_pause is not None:
+            self.on_pause(seconds, lateness)
+
+    def played(self, seconds):
+        """
+        Records a whole playback.
+        """
+        self.phase('playback', seconds)
+
+    def report(self) -> MetricsReport:
+        """
+        Returns the timings of each phase, the number of events sent and
+        their rate over the playbacks, the histograms of the batch sizes
+        (size -> count) and of the lateness (bucket upper bound -> count),
+        and the hit rate of each cache.
+        """
+        with self.lock:
+            phases = {name: PhaseStats(*stats) for name, stats in self._phases.items()}
+            playback = phases.get('playback')
+            return MetricsReport(
+                phases,
+                self._events,
+                self._events / playback.total if playback and playback.total else 0.0,
+                dict(sorted(self._batch_sizes.items())),
+                dict(zip(LATENESS_BUCKETS, self._lateness)),
+                {name: HitRate(hits, misses, hits / (hits + misses))
+                 for name, (hits, misses) in self._caches.items()})
+
+
+# the instrumentation in use, if any: checked before measuring anything
+_metrics = None
+
+
+def enable_metrics(metrics: Metrics=None) -> Metrics:
+    """
+    Starts recording into `metrics` (a new `Metrics` if `None`), which
+    is returned. Meanwhile, keys are always played from Python, see
+    `Metrics`.
+    """
+    global _metrics
+    if metrics is None:
+        metrics = Metrics()
+    _metrics = metrics
+    return metrics
+
+
+def disable_metrics():
+    global _metrics
+    _metrics = None
+
 
 class KeySequenceError(Exception):
     """Exception raised when a key sequence string has a syntax error"""
@@ -316,13 +669,35 @@ class Layout:
         "_chars_to_scancodes",
         "_vk_to_scancode",
         "_scan_code_to_vk",
+        "_char_keys",
+        "_char_inputs",
+        "_index",
+        "_unmapped_chars",
+        "_api",
+        "_swept",
+        "key",
         "lock"
     )
 
-    def __init__(self):
+    def __init__(self, key=None, api=None):
+        """
+        `key` : object
+            The identity of the keyboard layout (usually its ``HKL``).
+        `api` : object
+            When given, the layout is lazy: characters and virtual keys
+            missing from the tables are resolved through these ``user32``
+            functions on first use, see `_setup_tables`.
+        """
         self._chars_to_scancodes = {}
         self._vk_to_scancode = {}
         self._scan_code_to_vk = {}
+        self._char_keys = {}
+        self._char_inputs = {}
+        self._index = {}
+        self._unmapped_chars = set()
+        self._api = api
+        self._swept = api is None
+        self.key = key
         self.lock = Lock()
 
     @property
@@ -346,11 +721,211 @@ class Layout:
         if vk is not None:
             self.add_scancode_to_vk(scancode, vk)
 
+    def vk2scancode(self, vk) -> int:
+        try:
+            return self._vk_to_scancode[vk]
+        except KeyError:
+            if self._api is None:
+                return 0
+
+        scancode = self._api.MapVirtualKeyExW(vk, USER32_MAPVK_VK_TO_VSC, self.key)
+        with self.lock:
+            if scancode and scancode not in self._scan_code_to_vk:
+                self.add_scancode_to_vk(scancode, vk)
+            else:
+                self._vk_to_scancode[vk] = scancode
+        return scancode
+
     def char2keycode(self, c) -> typing.Tuple[int, int]:
-        scancode, flags = self._chars_to_scancodes[c]
+        try:
+            scancode, flags = self._chars_to_scancodes[c]
+        except KeyError:
+            if self._swept:
+                raise
+            scancode, flags = self._resolve_char(c)
         return self._scan_code_to_vk[scancode], flags
 
+    def char_keys(self, c) -> tuple:
+        """
+        Returns the 2-tuples (see `str2keys`) typing the character `c`,
+        modifiers included, or ``((c, True),)`` if the layout can't type
+        it. The result is memoized.
+        """
+        try:
+            return self._char_keys[c]
+        except KeyError:
+            pass
+
+        keys = []
+        try:
+            _append_key(self.lookup(c), keys, self)
+        except KeySequenceError:
+            keys.append((c, True))
+            self._unmapped_chars.add(c)
+        keys = self._char_keys[c] = tuple(keys)
+        return keys
+
+    def char_inputs(self, c) -> bytes:
+        """
+        Returns the raw `INPUT` structures typing the character `c` (see
+        `char_keys`), ready to be copied into a send buffer. The result
+        is memoized.
+        """
+        try:
+            return self._char_inputs[c]
+        except KeyError:
+            pass
+
+        buffer = _InputBuffer(4)
+        for vk, down in self.char_keys(c):
+            if type(vk) is str:
+                buffer.add_unicode(vk)
+            else:
+                buffer.add_key(vk.code, vk.scancode, (KEYEVENTF_EXTENDEDKEY if vk.extended else 0)
+                               | (0 if down else KEYEVENTF_KEYUP))
+        inputs = self._char_inputs[c] = bytes(buffer.view[:buffer.count * _INPUT_SIZE])
+        return inputs
+
+    def _resolve_char(self, c) -> typing.Tuple[int, int]:
+        """
+        Looks up a character missing from a lazy layout, first with
+        ``VkKeyScanEx`` then, if it can't be typed that way, by sweeping
+        the whole layout once.
+        """
+        res = self._api.VkKeyScanExW(c, self.key)
+        if res != -1:
+            vk = res & 0xFF
+            flags = _VK_KEY_SCAN_FLAGS.get((res >> 8) & 0xFF)
+            if flags is not None:
+                scancode = self.vk2scancode(vk)
+                if scancode:
+                    with self.lock:
+                        if c not in self._chars_to_scancodes:
+                            self.associate_char_to_scancode(c, scancode, vk, flags)
+                    return self._chars_to_scancodes[c]
+
+        # characters such as "\n" only map to a CTRL combination,
+        # they are known anyway: don't pay a full sweep for them.
+        if c in CODES:
+            raise KeyError(c)
+
+        self._ensure_swept()
+        return self._chars_to_scancodes[c]
+
+    def _ensure_swept(self):
+        with self.lock:
+            if not self._swept:
+                metrics = _metrics
+                start = time.perf_counter() if metrics is not None else 0
+                _scan_layout(self, self._api, self.key)
+                self._swept = True
+                if metrics is not None:
+                    metrics.phase('layout', time.perf_counter() - start)
+
+    def dump(self, path):
+        """
+        Writes the layout to `path` as a snapshot that `Layout.load`
+        can map back into memory. A lazy layout is fully scanned first.
+        """
+        self._ensure_swept()
+
+        with self.lock:
+            chars = sorted((ord(c), scancode, flags)
+                           for c, (scancode, flags) in self._chars_to_scancodes.items())
+            vks = sorted(self._vk_to_scancode.items())
+            scans = sorted(self._scan_code_to_vk.items())
+
+        import json
+
+        key = json.dumps(self.key).encode('utf-8')
+        key += b'\0' * (-len(key) % 4)
+
+        with open(path, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(
+                _SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, sys.byteorder == 'little',
+                len(chars), len(vks), len(scans), len(key)))
+            f.write(key)
+            for table in (chars, vks, scans):
+                for column in zip(*table):
+                    array('I', column).tofile(f)
+
+    @classmethod
+    def load(cls, path) -> 'Layout':
+        """
+        Maps a snapshot written by `Layout.dump` into memory. The tables
+        are read in place from the mapping: nothing is parsed upfront,
+        no ``user32`` call is made and processes loading the same file
+        share its pages.
+        """
+        with open(path, 'rb') as f:
+            buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        try:
+            magic, version, little, n_chars, n_vks, n_scans, key_size = \
+                _SNAPSHOT_HEADER.unpack_from(buf)
+        except struct.error:
+            raise ValueError("'{}' is not a layout snapshot".format(path))
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise ValueError("'{}' is not a layout snapshot".format(path))
+        if little != (sys.byteorder == 'little'):
+            raise ValueError("'{}' was written on a machine of different endianness".format(path))
+
+        pos = _SNAPSHOT_HEADER.size
+        if len(buf) != pos + key_size + 4 * (3 * n_chars + 2 * n_vks + 2 * n_scans):
+            raise ValueError("'{}' is truncated".format(path))
+
+        import json
+
+        layout = cls(json.loads(bytes(buf[pos:pos + key_size]).rstrip(b'\0')))
+        pos += key_size
+
+        def column(n):
+            nonlocal pos
+            view = buf[pos:pos + 4 * n].cast('I')
+            pos += 4 * n
+            return view
+
+        layout._chars_to_scancodes = _PackedCharTable(column(n_chars), column(n_chars), column(n_chars))
+        layout._vk_to_scancode = _PackedTable(column(n_vks), column(n_vks))
+        layout._scan_code_to_vk = _PackedTable(column(n_scans), column(n_scans))
+        return layout
+
+    def virtual_key(self, vk: int, flags=DEFAULT_FLAG) -> VirtualKey:
+        """
+        Returns the `VirtualKey` of the virtual key code `vk`.
+        """
+        return VirtualKey(vk, self.vk2scancode(vk), vk in EXTENDED_KEYS, flags)
+
+    def lookup(self, key) -> VirtualKey:
+        """
+        Returns the `VirtualKey` of `key`: a character, a key name (see
+        `CODES`) or a virtual key code. Every key is resolved once, then
+        found in a single table.
+        """
+        try:
+            return self._index[key]
+        except KeyError:
+            pass
+
+        if type(key) is int:
+            virtual_key = self.virtual_key(key)
+        else:
+            virtual_key = self.virtual_key(*self._resolve_key(key))
+        self._index[key] = virtual_key
+        return virtual_key
+
+    def _build_index(self):
+        """
+        Resolves every character and key name of the layout upfront.
+        """
+        for key in chain(self._chars_to_scancodes, CODES):
+            self.lookup(key)
+
     def key_to_code(self, key) -> typing.Tuple[int, int]:
+        virtual_key = self.lookup(key)
+        return virtual_key.code, virtual_key.flags
+
+    def _resolve_key(self, key) -> typing.Tuple[int, int]:
         # the key is a char, try to get a scan code for it
         try:
             if len(key) == 1:
@@ -371,45 +946,435 @@ class Layout:
         raise KeySequenceError("'{}' is an unknown key".format(key))
 
 
-def _setup_tables():
+# magic, version, little endian?, number of chars, of vks, of scan codes,
+# size of the layout key. Followed by the key (JSON) and the tables, stored
+# column by column as native uint32 arrays sorted by their first column:
+# (char, scancode, flags), (vk, scancode) and (scancode, vk).
+_SNAPSHOT_HEADER = struct.Struct('=4sH?xIIII')
+_SNAPSHOT_MAGIC = b'SKLT'
+_SNAPSHOT_VERSION = 1
+
+assert array('I').itemsize == 4
+
+# shift states returned by `VkKeyScanEx` that we know how to reproduce
+_VK_KEY_SCAN_FLAGS = {
+    0: Layout.DEFAULT_FLAG,
+    1: Layout.REQUIRES_SHIFT,
+    6: Layout.REQUIRES_ALT_GR,  # CTRL+ALT
+}
+
+
+def _current_layout_key(api):
+    """
+    Returns the keyboard layout (``HKL``) of the thread owning the
+    foreground window, which is the one that will receive the keys.
+    """
+    thread_id = api.GetWindowThreadProcessId(api.GetForegroundWindow(), None)
+    return api.GetKeyboardLayout(thread_id)
+
+
+def _setup_tables(api=None, hkl=None, lazy=False):
     """
     Ensures the scan code/virtual key code/name translation tables are
     filled.
+
+    `api` : object
+        The ``user32`` functions to query, defaults to the real ``user32``.
+        Any object exposing ``MapVirtualKeyExW`` and ``ToUnicodeEx`` (and
+        ``GetKeyboardLayout`` & co. when `hkl` is not given) will do.
+    `hkl` : int
+        The keyboard layout to scan, defaults to the layout of the
+        foreground window.
+    `lazy` : bool
+        Whether to skip the scan and resolve characters on first use
+        instead (through ``VkKeyScanExW``), falling back to a full scan
+        only for characters that can't be resolved that way.
     """
 
-    layout = Layout()
+    if api is None:
+        api = _load_user32()
+    if hkl is None:
+        hkl = _current_layout_key(api)
+
+    if lazy:
+        return Layout(hkl, api)
+
+    metrics = _metrics
+    start = time.perf_counter() if metrics is not None else 0
 
+    layout = Layout(hkl)
     with layout.lock:
-        for vk in range(0x01, 0x100):
-            if vk not in layout.vk_to_scancode:
-                scan_code = MapVirtualKey(vk, USER32_MAPVK_VK_TO_VSC)
-                if scan_code and scan_code not in layout.vk_to_scancode:
-                    layout.add_scancode_to_vk(scan_code, vk)
-
-        name_buffer = create_unicode_buffer(32)
-        keyboard_state = keyboard_state_type()
-        for scan_code in range(2 ** (23-16)):
-            # Get associated character, such as "^", possibly overwriting the pure key name.
-            modifiers_to_scan = ((VK_SHIFT, Layout.REQUIRES_SHIFT), (ALT_GR, Layout.REQUIRES_ALT_GR))
-            for state in [0, 1]:
-                for vk_state, state_flag in modifiers_to_scan:
-                    keyboard_state[vk_state] = state * 0xFF
-
-                    # Try both manual and automatic scan_code->vk translations.
-                    vk = user32.MapVirtualKeyW(scan_code, 3)
-                    ret = ToUnicode(vk, scan_code, keyboard_state, name_buffer, len(name_buffer), 0)
-
-                    if ret:
-                        char = name_buffer.value[-1]
-
-                        if char not in layout.chars_to_scancodes:
-                            layout.associate_char_to_scancode(char, scan_code, vk, state and state_flag or 0)
-
-                    # remove the hold
-                    keyboard_state[vk_state] = 0 * 0xFF
+        _scan_layout(layout, api, hkl)
+    layout._build_index()
+
+    if metrics is not None:
+        metrics.phase('layout', time.perf_counter() - start)
     return layout
 
 
+def _scan_layout(layout: Layout, api, hkl):
+    for vk in range(0x01, 0x100):
+        if vk not in layout.vk_to_scancode:
+            scan_code = api.MapVirtualKeyExW(vk, USER32_MAPVK_VK_TO_VSC, hkl)
+            if scan_code and scan_code not in layout.vk_to_scancode:
+                layout.add_scancode_to_vk(scan_code, vk)
+
+    name_buffer = create_unicode_buffer(32)
+    keyboard_state = keyboard_state_type()
+    for scan_code in range(2 ** (23-16)):
+        # Get associated character, such as "^", possibly overwriting the pure key name.
+        modifiers_to_scan = ((VK_SHIFT, Layout.REQUIRES_SHIFT), (ALT_GR, Layout.REQUIRES_ALT_GR))
+        for state in [0, 1]:
+            for vk_state, state_flag in modifiers_to_scan:
+                keyboard_state[vk_state] = state * 0xFF
+
+                # Try both manual and automatic scan_code->vk translations.
+                vk = api.MapVirtualKeyExW(scan_code, USER32_MAPVK_VSC_TO_VK_EX, hkl)
+                ret = api.ToUnicodeEx(vk, scan_code, keyboard_state, name_buffer, len(name_buffer), 0, hkl)
+
+                if ret:
+                    char = name_buffer.value[-1]
+
+                    if char not in layout.chars_to_scancodes:
+                        layout.associate_char_to_scancode(char, scan_code, vk, state and state_flag or 0)
+
+                # remove the hold
+                keyboard_state[vk_state] = 0 * 0xFF
+
+
+class LayoutCache:
+    """
+    Thread-safe cache of `Layout` objects, keyed by keyboard layout.
+
+    A layout is scanned the first time it is requested and reused
+    afterwards; when the active layout changes, its own entry is
+    looked up (and built if needed) instead.
+
+    `api` : object
+        The ``user32`` functions to build layouts with, see `_setup_tables`.
+    `key_func` : callable
+        Returns the identity of the active layout, defaults to the
+        ``HKL`` of the foreground window. The key is handed over to
+        `api` as the layout to scan.
+    `lazy` : bool
+        Whether to build lazy layouts, see `_setup_tables`.
+    """
+
+    __slots__ = (
+        "_api",
+        "_key_func",
+        "_lazy",
+        "_layouts",
+        "lock"
+    )
+
+    def __init__(self, api=None, key_func=None, lazy=False):
+        self._api = api
+        self._key_func = key_func
+        self._lazy = lazy
+        self._layouts = {}
+        self.lock = Lock()
+
+    def current_key(self):
+        if self._key_func is not None:
+            return self._key_func()
+        return _current_layout_key(self._api or _load_user32())
+
+    def get(self, key=None) -> Layout:
+        """
+        Returns the layout for `key`, or for the active layout if `key`
+        is `None`, building it if it isn't cached yet.
+        """
+        if key is None:
+            key = self.current_key()
+
+        layout = self._layouts.get(key)
+        metrics = _metrics
+        if metrics is not None:
+            metrics.cache('layout', layout is not None)
+        if layout is None:
+            with self.lock:
+                # another thread may have built it while we were waiting
+                layout = self._layouts.get(key)
+                if layout is None:
+                    layout = self._layouts[key] = _setup_tables(self._api, key, self._lazy)
+        return layout
+
+    def refresh(self, key=None) -> Layout:
+        """
+        Discards the cached layout for `key` (the active layout if `None`)
+        and builds it again.
+        """
+        if key is None:
+            key = self.current_key()
+        with self.lock:
+            self._layouts.pop(key, None)
+        return self.get(key)
+
+    def add(self, layout: Layout, key=None):
+        """
+        Caches an already built layout, such as one loaded from a
+        snapshot, under `key` (defaults to the layout's own key).
+        """
+        with self.lock:
+            self._layouts[layout.key if key is None else key] = layout
+
+    def invalidate(self, key=None):
+        """
+        Discards the cached layout for `key`, or every cached layout if
+        `key` is `None`.
+        """
+        with self.lock:
+            if key is None:
+                self._layouts.clear()
+            else:
+                self._layouts.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._layouts
+
+    def __len__(self):
+        return len(self._layouts)
+
+
+# shared by every `SendKeys` call that doesn't provide its own layout,
+# lazy so that typing a few characters doesn't require a full scan.
+layout_cache = LayoutCache(lazy=True)
+
+
+# don't let the shell know about the layouts loaded to be scanned
+KLF_NOTELLSHELL = 0x80
+
+
+def _layout_klid(layout_id: str) -> str:
+    """
+    Returns the keyboard layout identifier (``KLID``, such as
+    ``"00000407"``) of a locale name (such as ``"de-DE"``), that is its
+    default layout, or of a ``KLID``.
+    """
+    if len(layout_id) == 8 and all(c in '0123456789abcdefABCDEF' for c in layout_id):
+        return layout_id
+    lcid = _load_kernel32().LocaleNameToLCID(layout_id, 0)
+    if not lcid:
+        raise ValueError("unknown keyboard layout: '{}'".format(layout_id))
+    return '%08X' % lcid
+
+
+def _loaded_layouts(api) -> set:
+    """
+    Returns the keyboard layouts (``HKL``) loaded in the user's input
+    languages.
+    """
+    count = api.GetKeyboardLayoutList(0, None)
+    layouts = (HKL * count)()
+    count = api.GetKeyboardLayoutList(count, layouts)
+    return set(layouts[:count])
+
+
+def _layout_size(layout: Layout) -> int:
+    """
+    Returns the approximate number of bytes used by the tables of
+    `layout`, snapshots excepted since they are mapped from a file.
+    """
+    size = sys.getsizeof(layout)
+    for table in (layout._chars_to_scancodes, layout._vk_to_scancode, layout._scan_code_to_vk,
+                  layout._char_keys, layout._char_inputs, layout._index, layout._unmapped_chars):
+        if isinstance(table, _PackedTable):
+            continue
+        size += sys.getsizeof(table)
+        if isinstance(table, dict):
+            size += sum(sys.getsizeof(value) for value in table.values())
+    return size
+
+
+LayoutStats = namedtuple('LayoutStats', ('key', 'build_time', 'memory'))
+RegistryReport = namedtuple('RegistryReport', ('layouts', 'memory', 'build_time'))
+
+
+class LayoutRegistry:
+    """
+    Keyboard layouts built ahead of time and kept resident, looked up by
+    identifier: a locale name (``"de-DE"``, for the default layout of
+    the language), a ``KLID`` (``"00000407"``) or an ``HKL``.
+
+    `api` : object
+        The ``user32`` functions to build layouts with (see
+        `_setup_tables`), along with ``LoadKeyboardLayoutW``,
+        ``UnloadKeyboardLayout`` and ``GetKeyboardLayoutList``.
+    `cache` : LayoutCache
+        Where to add the layouts built, so that they are used whenever
+        they become the active layout. Defaults to `layout_cache`.
+
+    The layouts loaded to be scanned are unloaded once built, unless
+    they were among the user's input languages already.
+    """
+
+    __slots__ = (
+        "_api",
+        "_cache",
+        "_layouts",
+        "_stats",
+        "_build_locks",
+        "_loaded",
+        "build_time",
+        "lock"
+    )
+
+    def __init__(self, api=None, cache: LayoutCache=None):
+        self._api = api
+        self._cache = layout_cache if cache is None else cache
+        self._layouts = {}
+        self._stats = {}
+        self._build_locks = {}  # layout_id -> Lock, see `get`
+        self._loaded = {}  # HKL loaded by the registry -> builds using it
+        self.build_time = 0.0
+        self.lock = Lock()
+
+    def _load(self, api, layout_id):
+        """
+        Loads the layout of `layout_id`, a string, returning its ``HKL``
+        and whether it has to be unloaded once built (see `_unload`).
+        """
+        klid = _layout_klid(layout_id)
+        with self.lock:
+            loaded = _loaded_layouts(api)
+            hkl = api.LoadKeyboardLayoutW(klid, KLF_NOTELLSHELL)
+            if not hkl:
+                raise ValueError("can't load keyboard layout: '{}'".format(layout_id))
+            # another build may have loaded it meanwhile
+            if hkl in loaded and hkl not in self._loaded:
+                return hkl, False
+            self._loaded[hkl] = self._loaded.get(hkl, 0) + 1
+        return hkl, True
+
+    def _unload(self, api, hkl):
+        with self.lock:
+            self._loaded[hkl] -= 1
+            if not self._loaded[hkl]:
+                del self._loaded[hkl]
+                api.UnloadKeyboardLayout(hkl)
+
+    def _build(self, layout_id) -> Layout:
+        api = self._api or _load_user32()
+        start = time.perf_counter()
+
+        hkl, unload = layout_id, False
+        if isinstance(layout_id, str):
+            hkl, unload = self._load(api, layout_id)
+        try:
+            layout = _setup_tables(api, hkl)
+        finally:
+            if unload:
+                self._unload(api, hkl)
+
+        with self.lock:
+            self._layouts[layout_id] = layout
+            self._stats[layout_id] = LayoutStats(hkl, time.perf_counter() - start, _layout_size(layout))
+        self._cache.add(layout)
+        return layout
+
+    def warm(self, layout_ids, max_workers=None) -> RegistryReport:
+        """
+        Builds the layouts of `layout_ids` that aren't yet, concurrently
+        on a pool of `max_workers` threads, then returns the `report`.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        missing = [layout_id for layout_id in dict.fromkeys(layout_ids) if layout_id not in self._layouts]
+        start = time.perf_counter()
+        if missing:
+            with ThreadPoolExecutor(max_workers) as executor:
+                # raises the first error, if any
+                list(executor.map(self.get, missing))
+        self.build_time = time.perf_counter() - start
+        return self.report()
+
+    def get(self, layout_id) -> Layout:
+        """
+        Returns the layout of `layout_id`, building it if it wasn't.
+        """
+        layout = self._layouts.get(layout_id)
+        if layout is None:
+            # a lock per layout, so that different layouts build in parallel
+            with self.lock:
+                build_lock = self._build_locks.setdefault(layout_id, Lock())
+            with build_lock:
+                # another thread may have built it while we were waiting
+                layout = self._layouts.get(layout_id)
+                if layout is None:
+                    layout = self._build(layout_id)
+        return layout
+
+    def report(self) -> RegistryReport:
+        """
+        Returns the key, build time and memory of each layout, their
+        total memory and how long the last `warm` took.
+        """
+        with self.lock:
+            stats = dict(self._stats)
+        return RegistryReport(stats, sum(layout.memory for layout in stats.values()), self.build_time)
+
+    def __contains__(self, layout_id):
+        return layout_id in self._layouts
+
+    def __len__(self):
+        return len(self._layouts)
+
+
+# used by `SendKeys` & co. when given the identifier of a layout
+layout_registry = LayoutRegistry()
+
+
+class KeyRepeat:
+    """
+    A sequence of keys repeated `count` times, as produced by the ``[N]``
+    multipliers. Iterating over it expands it lazily, `keys` may hold
+    nested `KeyRepeat`.
+    """
+
+    __slots__ = (
+        "keys",
+        "count"
+    )
+
+    def __init__(self, keys, count: int):
+        self.keys = tuple(keys)
+        self.count = count
+
+    def __iter__(self):
+        for _ in range(self.count):
+            yield from _expand(self.keys)
+
+    def __len__(self):
+        return _expanded_len(self.keys) * self.count
+
+    def __eq__(self, other):
+        if type(other) is not KeyRepeat:
+            return NotImplemented
+        return self.keys == other.keys and self.count == other.count
+
+    def __hash__(self):
+        return hash((self.keys, self.count))
+
+    def __repr__(self):
+        return 'KeyRepeat({!r}, {})'.format(self.keys, self.count)
+
+
+def _expand(keys):
+    """
+    Iterates over `keys` as 2-tuples, expanding `KeyRepeat` on the fly.
+    """
+    for key in keys:
+        if type(key) is KeyRepeat:
+            yield from key
+        else:
+            yield key
+
+
+def _expanded_len(keys) -> int:
+    return sum(len(key) if type(key) is KeyRepeat else 1 for key in keys)
+
+
 def _parse_pause_key(key: str):
     if len(key) > len(PAUSE_CMD) and key.startswith(PAUSE_CMD):
         try:
@@ -420,30 +1385,61 @@ def _parse_pause_key(key: str):
 
 
 def _append_char(keys, c, layout: Layout):
+    keys += layout.char_keys(c)
+
+
+def _append_text(keys, text, layout: Layout):
+    start = len(keys)
+    table = layout._char_keys
     try:
-        res = layout.key_to_code(c)
-        _append_key(res, keys)
-    except KeySequenceError:
-        keys.append((c, True))
+        keys += chain.from_iterable([table[c] for c in text])
+    except KeyError:
+        char_keys = layout.char_keys
+        keys += chain.from_iterable([char_keys(c) for c in text])
+
+    unmapped = layout._unmapped_chars
+    if unmapped and not unmapped.isdisjoint(text):
+        keys[start:] = _merge_unicode(keys[start:])
+
+
+def _merge_unicode(keys) -> list:
+    """
+    Collapses consecutive ``(char, True)`` events, for characters the
+    layout can't type, into single ``(text, True)`` events so that each
+    run is typed in one batch.
+    """
+    merged = []
+    run = []
+    for key in keys:
+        if type(key[0]) is str:
+            run.append(key[0])
+        else:
+            if run:
+                merged.append((''.join(run), True))
+                run = []
+            merged.append(key)
+    if run:
+        merged.append((''.join(run), True))
+    return merged
 
 
-def _append_key(virtual_key, output, down=True, up=True):
-    return _append_keys([virtual_key], output, down, up)
+def _append_key(virtual_key, output, layout: Layout, down=True, up=True):
+    return _append_keys([virtual_key], output, layout, down, up)
 
 
-def _append_keys(virtual_keys, output, down=True, up=True):
-    def _handle_flag(_vk, _flag):
+def _append_keys(virtual_keys, output, layout: Layout, down=True, up=True):
+    def _handle_flag(_flag):
         if (_flag & Layout.REQUIRES_SHIFT) == Layout.REQUIRES_SHIFT:
-            return [VK_SHIFT]
+            return [layout.lookup(VK_SHIFT)]
         elif (_flag & Layout.REQUIRES_ALT_GR) == Layout.REQUIRES_ALT_GR:
-            return [ALT_GR]
+            return [layout.lookup(ALT_GR)]
         return []
 
     def _append(_actions, _state, _out):
         _out +=  [(_action, _state) for _action in _actions]
 
-    for vk, flag in virtual_keys:
-        actions = _handle_flag(vk, flag)
+    for vk in virtual_keys:
+        actions = _handle_flag(vk.flags)
         if down:
             _append(actions, True, output)
             output.append((vk, True))
@@ -463,7 +1459,7 @@ def _parse_multiplier(s: str, pos: int) -> (int, int):
     c = None
     while True:
         pos += 1
-        if len(s) < pos:
+        if len(s) <= pos:
             raise KeySequenceError("Was expecting ']'")
 
         c = s[pos]
@@ -489,7 +1485,7 @@ def _parse_combo(s: str, pos: int, layout: Layout) -> (int, int):
 
     while True:
         pos += 1
-        if len(s) < pos:
+        if len(s) <= pos:
             raise KeySequenceError("Was expecting '}'")
 
         c = s[pos]
@@ -511,9 +1507,9 @@ def _parse_combo(s: str, pos: int, layout: Layout) -> (int, int):
 
             pause_cmd = _parse_pause_key(found_key)
             if pause_cmd:
-                keys_up += [pause_cmd] * multiplier
+                keys_up.append(pause_cmd if multiplier == 1 else KeyRepeat((pause_cmd,), multiplier))
             else:
-                vk = layout.key_to_code(found_key)
+                vk = layout.lookup(found_key)
 
                 # append the found key and multiply it by the given multiplier or by one
                 # if the multiplier is not one, we switch the status between DOWN and UP.
@@ -530,11 +1526,12 @@ def _parse_combo(s: str, pos: int, layout: Layout) -> (int, int):
                 # Which means:
                 #    `multiplier == 1` -> before (down) and after (up) `multiplier > 1`
                 if multiplier != 1:
-                    for i in range(multiplier):
-                        _append_key(vk, keys)
+                    pressed = []
+                    _append_key(vk, pressed, layout)
+                    keys.append(KeyRepeat(pressed, multiplier))
                 else:
-                    _append_key(vk, keys_down, True, False)
-                    _append_key(vk, keys_up, False, True)
+                    _append_key(vk, keys_down, layout, True, False)
+                    _append_key(vk, keys_up, layout, False, True)
 
             # reset values
             current_key_chars = []
@@ -553,11 +1550,69 @@ def _parse_combo(s: str, pos: int, layout: Layout) -> (int, int):
     next_c = _peek_char(s, pos)
     if next_c == "[":
         multiplier, pos = _parse_multiplier(s, pos)
-        keys *= multiplier
+        keys = [KeyRepeat(keys, multiplier)]
 
     return keys, pos
 
 
+def _strip_ignored(key_string, with_spaces, with_tabs, with_newlines):
+    """
+    Removes the characters that `str2keys` is told to ignore.
+    """
+    if not (with_spaces and with_tabs and with_newlines):
+        ignored_chars = (' ' if not with_spaces else '')\
+                        + ('\t' if not with_tabs else '') \
+                        + ('\n' if not with_newlines else '')
+
+        key_string = key_string.translate(_IGNORED_CHARS_TABLES[ignored_chars])
+    return key_string
+
+
+# `str.translate` tables deleting every combination of ignored characters
+_IGNORED_CHARS_TABLES = {
+    ''.join(c for c, ignored in zip(' \t\n', flags) if ignored):
+        dict.fromkeys(ord(c) for c, ignored in zip(' \t\n', flags) if ignored)
+    for flags in ((s, t, n) for s in (True, False) for t in (True, False) for n in (True, False))
+}
+
+# a run of characters with no special meaning
+_TEXT_RUN = re.compile(r'[^{\\]+')
+
+
+def _parse_keys(key_string, layout: Layout):
+    """
+    Parses an already stripped `key_string` into a list of 2-tuples
+    and `KeyRepeat`.
+    """
+    metrics = _metrics
+    start = time.perf_counter() if metrics is not None else 0
+
+    pos = 0
+    length = len(key_string)
+    match_text = _TEXT_RUN.match
+
+    # results
+    keys = []
+
+    while pos < length:
+        text = match_text(key_string, pos)
+        if text is not None:
+            _append_text(keys, text.group(), layout)
+            pos = text.end()
+        elif key_string[pos] == "{":
+            combo_keys, pos = _parse_combo(key_string, pos, layout)
+            keys += combo_keys
+        else:
+            # "\\": the next character is sent as is
+            if pos + 1 < length:
+                _append_char(keys, key_string[pos + 1], layout)
+            pos += 2
+
+    if metrics is not None:
+        metrics.parsed(key_string, _expanded_len(keys), time.perf_counter() - start)
+    return keys
+
+
 def str2keys(key_string,
              layout: Layout,
              with_spaces=False,
@@ -579,81 +1634,1109 @@ def str2keys(key_string,
     """
 
     # remove any ignored character
-    if not (with_spaces and with_tabs and with_newlines):
-        ignored_chars = (' ' if not with_spaces else '')\
-                        + ('\t' if not with_tabs else '') \
-                        + ('\n' if not with_newlines else '')
+    key_string = _strip_ignored(key_string, with_spaces, with_tabs, with_newlines)
+    return list(_expand(_parse_keys(key_string, layout)))
 
-        chars = []
-        for c in key_string:
-            if c not in ignored_chars:
-                chars.append(c)
 
-        key_string = ''.join(chars)
-        del chars, ignored_chars
+Optimization = namedtuple('Optimization', ('keys', 'removed'))
 
-    # vars
-    pos = 0
-    next_is_raw = False
 
-    # results
-    keys = []
+def optimize_keys(keys) -> Optimization:
+    """
+    Removes the events of parsed keys (see `str2keys`) that don't
+    change what gets typed:
 
-    while pos < len(key_string):
-        c = key_string[pos]
+    - a modifier released and pressed again right away to press
+      another key is kept held (unless it was pressed alone), so that
+      consecutive characters requiring SHIFT (or ALTGR) share a single
+      press;
+    - consecutive pauses are merged.
 
-        if next_is_raw:
-            _append_char(keys, c, layout)
-            next_is_raw = False
-        elif c == "{":
-            combo_keys, pos = _parse_combo(key_string, pos, layout)
-            keys += combo_keys
-            continue
-        elif c == "\\":
-            next_is_raw = True
-        else:
-            _append_char(keys, c, layout)
+    A modifier tapped on its own is kept, applications may act on it.
 
-        pos += 1
+    The keys of a `KeyRepeat` are optimized on their own. Returns the
+    optimized keys and the number of events removed.
+    """
+    optimized = _optimize_keys(keys)
+    return Optimization(optimized, _expanded_len(keys) - _expanded_len(optimized))
 
-    return keys
 
+def _presses_key(keys, i) -> bool:
+    """
+    Returns whether `keys[i]` presses a key other than a modifier.
+    """
+    if i >= len(keys) or type(keys[i]) is KeyRepeat:
+        return False
+    vk, down = keys[i]
+    return down and vk is not None and type(vk) is not str and vk not in MODIFIER_KEYS
+
+
+def _optimize_keys(keys) -> list:
+    keys = list(keys)
+    optimized = []
+    for i, key in enumerate(keys):
+        if type(key) is KeyRepeat:
+            optimized.append(KeyRepeat(_optimize_keys(key.keys), key.count))
+            continue
 
-def _send_event(vk, event_type, layout: Layout):
-    if vk < 0:
+        if optimized and type(optimized[-1]) is not KeyRepeat:
+            vk, arg = key
+            last_vk, last_arg = optimized[-1]
+            if vk is None and last_vk is None:
+                optimized[-1] = (None, last_arg + arg)
+                continue
+            if vk in MODIFIER_KEYS and type(last_vk) is not str and vk == last_vk:
+                # released then pressed again to type a key, unless it was
+                # tapped on its own, before (tapping ALT twice isn't tapping
+                # it once) or after.
+                if arg and not last_arg and optimized[-2:-1] != [(vk, True)] and _presses_key(keys, i + 1):
+                    optimized.pop()
+                    continue
+        optimized.append(key)
+    return optimized
+
+
+def _complete_length(key_string) -> int:
+    """
+    Returns the length of the longest prefix of `key_string` that can be
+    parsed on its own, i.e. that doesn't end in the middle of a combo or
+    of an escape sequence, nor with a combo that could be followed by a
+    multiplier.
+    """
+    pos = end = 0
+    length = len(key_string)
+    match_text = _TEXT_RUN.match
+
+    while pos < length:
+        # plain text is complete wherever it stops, skip it as a whole
+        text = match_text(key_string, pos)
+        if text is not None:
+            pos = end = text.end()
+            continue
+
+        c = key_string[pos]
+        if c == "\\":
+            pos += 2
+        elif c == "{":
+            pos += 1
+            while pos < length and key_string[pos] != "}":
+                pos += 2 if key_string[pos] == "\\" else 1
+            pos += 1
+            if pos >= length:
+                break  # unterminated, or may be followed by a multiplier
+            if key_string[pos] == "[":
+                pos = key_string.find("]", pos) + 1 or length + 1
+
+        if pos > length:
+            break
+        end = pos
+    return end
+
+
+def _iter_chunks(source, chunk_size):
+    if isinstance(source, str):
+        yield source
+    elif hasattr(source, 'read'):
+        yield from iter(lambda: source.read(chunk_size), '')
+    else:
+        yield from source
+
+
+def iter_keys(source,
+              layout: Layout=None,
+              with_spaces=False,
+              with_tabs=False,
+              with_newlines=False,
+              chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Same as `str2keys` but parses `source` incrementally, yielding the
+    2-tuples as soon as they are known, so that the keys can be played
+    as the source is read, with a bounded memory use.
+
+    `source` : file, iterable of str or str
+        The keys to parse. A file object is read `chunk_size` characters
+        at a time, combos may be split across chunks.
+    `layout` : Layout
+        Defaults to the (cached) layout of the foreground window.
+    """
+    if layout is None:
+        layout = layout_cache.get()
+
+    pending = ''
+    for chunk in _iter_chunks(source, chunk_size):
+        pending += _strip_ignored(chunk, with_spaces, with_tabs, with_newlines)
+        end = _complete_length(pending)
+        if end:
+            yield from _expand(_parse_keys(pending[:end], layout))
+            pending = pending[end:]
+
+    if pending:
+        yield from _expand(_parse_keys(pending, layout))
+
+
+class KeyProgram:
+    """
+    An immutable, already parsed key sequence, as returned by
+    `compile_keys`. It can be given to `SendKeys` or `playkeys` in place
+    of a string and iterates over the same 2-tuples as `str2keys`.
+
+    `keys` holds the parsed 2-tuples and `KeyRepeat`, which are only
+    expanded while iterating. `removed` is the number of events dropped
+    by `optimize_keys`, if the program was optimized.
+    """
+
+    __slots__ = (
+        "source",
+        "keys",
+        "layout",
+        "with_spaces",
+        "with_tabs",
+        "with_newlines",
+        "removed",
+        "_events"
+    )
+
+    def __init__(self, source, keys, layout: Layout,
+                 with_spaces=False, with_tabs=False, with_newlines=False,
+                 removed=0):
+        for name, value in (("source", source),
+                            ("keys", tuple(keys)),
+                            ("layout", layout),
+                            ("with_spaces", with_spaces),
+                            ("with_tabs", with_tabs),
+                            ("with_newlines", with_newlines),
+                            ("removed", removed),
+                            ("_events", None)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'KeyProgram' object is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("'KeyProgram' object is read-only")
+
+    def __iter__(self):
+        return _expand(self.keys)
+
+    def __len__(self):
+        return _expanded_len(self.keys)
+
+    @property
+    def events(self) -> 'KeyEvents':
+        """
+        The program as `KeyEvents`, built once.
+        """
+        if self._events is None:
+            object.__setattr__(self, "_events", KeyEvents.from_keys(self.keys, self.layout))
+        return self._events
+
+    def __repr__(self):
+        return '<KeyProgram {!r}: {} events>'.format(self.source, len(self))
+
+
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'maxsize', 'currsize'))
+
+
+class ProgramCache:
+    """
+    Bounded, thread-safe LRU cache of `KeyProgram` objects, keyed by the
+    key string, the parsing flags and the layout they were compiled for.
+    """
+
+    __slots__ = (
+        "_programs",
+        "maxsize",
+        "hits",
+        "misses",
+        "lock"
+    )
+
+    def __init__(self, maxsize=256):
+        self._programs = OrderedDict()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key_string, layout: Layout,
+            with_spaces=False, with_tabs=False, with_newlines=False,
+            optimize=False) -> KeyProgram:
+        """
+        Returns the compiled program for the given arguments, compiling
+        it (see `str2keys` and `optimize_keys`) if it isn't cached.
+        """
+        cache_key = (key_string, with_spaces, with_tabs, with_newlines, optimize, layout)
+
+        with self.lock:
+            program = self._programs.get(cache_key)
+            metrics = _metrics
+            if metrics is not None:
+                metrics.cache('program', program is not None)
+            if program is not None:
+                self._programs.move_to_end(cache_key)
+                self.hits += 1
+                return program
+            self.misses += 1
+
+        keys = _parse_keys(_strip_ignored(key_string, with_spaces, with_tabs, with_newlines), layout)
+        removed = 0
+        if optimize:
+            keys, removed = optimize_keys(keys)
+        program = KeyProgram(key_string, keys, layout, with_spaces, with_tabs, with_newlines, removed)
+
+        with self.lock:
+            self._programs[cache_key] = program
+            while len(self._programs) > self.maxsize:
+                self._programs.popitem(last=False)
+        return program
+
+    def info(self) -> CacheInfo:
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._programs))
+
+    def clear(self):
+        with self.lock:
+            self._programs.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._programs)
+
+
+# shared by `compile_keys` and `SendKeys`
+program_cache = ProgramCache()
+
+
+def compile_keys(key_string,
+                 layout: Layout=None,
+                 with_spaces=False,
+                 with_tabs=False,
+                 with_newlines=False,
+                 optimize=False) -> KeyProgram:
+    """
+    Parses `key_string` into a `KeyProgram` that can be sent any number
+    of times without being parsed again. Programs are cached, see
+    `program_cache`.
+
+    The arguments are the same as `str2keys`, `layout` defaulting to the
+    (cached) layout of the foreground window. `optimize` runs the parsed
+    keys through `optimize_keys`.
+    """
+    if layout is None:
+        layout = layout_cache.get()
+    return program_cache.get(key_string, layout, with_spaces, with_tabs, with_newlines, optimize)
+
+
+def _key_codes(vk, layout: Layout) -> typing.Tuple[int, int]:
+    """
+    Returns the ``(vk, scancode)`` to send for `vk`, a negative `vk`
+    being a scan code.
+    """
+    if type(vk) is VirtualKey:
+        return vk.code, vk.scancode
+    if vk < 0:
         code = -vk
-        vk = layout.scan_code_to_vk.get(code, 0)
+        return layout.scan_code_to_vk.get(code, 0), code
+    return vk, layout.vk2scancode(vk)
+
+
+# packed events, as played by `_sendkeys.play`: opcode, flags, vk, scan
+# code, reserved, payload (UTF-16 code unit, nanoseconds or repeat count)
+_PACKED_EVENT = struct.Struct('=BBHHHQ')
+
+OP_KEY_DOWN = 1
+OP_KEY_UP = 2
+OP_UNICODE = 3
+OP_PAUSE = 4
+OP_REPEAT = 5  # repeats the events up to the matching `OP_END`
+OP_END = 6
+
+EVENT_EXTENDED = 0x1
+EVENT_MODIFIER = 0x2
+
+
+def _key_records(key, layout: Layout) -> list:
+    """
+    Returns the records (see `_PACKED_EVENT`) of a 2-tuple.
+    """
+    vk, arg = key
+    if not vk:
+        return [(OP_PAUSE, 0, 0, 0, 0, round(arg * 1e9))]
+    if type(vk) is str:
+        return [(OP_UNICODE, 0, 0, 0, 0, unit)
+                for unit in memoryview(vk.encode(_UTF16, 'surrogatepass')).cast('H')]
+    if type(vk) is VirtualKey:
+        # resolved at parse time
+        flags = EVENT_EXTENDED if vk.extended else 0
+        vk, scan = vk.code, vk.scancode
     else:
-        code = layout.vk_to_scancode[vk]
-    user32.keybd_event(vk, code, event_type, 0)
+        vk, scan = _key_codes(vk, layout)
+        flags = EVENT_EXTENDED if vk in EXTENDED_KEYS else 0
+    if vk in MODIFIER_KEYS:
+        flags |= EVENT_MODIFIER
+    return [(OP_KEY_DOWN if arg else OP_KEY_UP, flags, vk, scan, 0, 0)]
+
+
+def _pack_events(keys, layout: Layout, packed=None) -> bytearray:
+    """
+    Packs 2-tuples and `KeyRepeat` into records (see `_PACKED_EVENT`),
+    resolving the scan codes on the way.
+    """
+    if packed is None:
+        packed = bytearray()
+    pack = _PACKED_EVENT.pack
+
+    for key in keys:
+        if type(key) is KeyRepeat:
+            packed += pack(OP_REPEAT, 0, 0, 0, 0, key.count)
+            _pack_events(key.keys, layout, packed)
+            packed += pack(OP_END, 0, 0, 0, 0, 0)
+        else:
+            for record in _key_records(key, layout):
+                packed += pack(*record)
+    return packed
+
+
+def _iter_records(keys, layout: Layout):
+    """
+    Iterates over the records of 2-tuples and `KeyRepeat`, expanding the
+    repeats.
+    """
+    for key in _expand(keys):
+        yield from _key_records(key, layout)
+
+
+KeyEvent = namedtuple('KeyEvent', ('op', 'flags', 'vk', 'scan', 'reserved', 'payload'))
+
+
+def _check_repeats(segments):
+    """
+    Raises `ValueError` unless each `OP_REPEAT` of the records of
+    `segments` has its `OP_END`, and the other way around.
+    """
+    size = _PACKED_EVENT.size
+    depth = 0
+    for segment in segments:
+        # the opcode is the first byte of each record
+        ops = bytes(segment[::size])
+        if OP_REPEAT not in ops and OP_END not in ops and not depth:
+            continue
+        for op in ops:
+            if op == OP_REPEAT:
+                depth += 1
+            elif op == OP_END:
+                if not depth:
+                    raise ValueError("a KeyEvents slice can't cut through a repeat")
+                depth -= 1
+    if depth:
+        raise ValueError("a KeyEvents slice can't cut through a repeat")
+
+
+class KeyEvents:
+    """
+    A compact, immutable sequence of key events: fixed-width records (see
+    `_PACKED_EVENT`) of an opcode, flags, virtual key, scan code and a
+    payload (pause in nanoseconds, UTF-16 code unit or repeat count).
+
+    Indexing returns `KeyEvent` records, repeat markers included, out of
+    `record_count`. Slicing and concatenating share the underlying
+    buffers instead of copying them (a slice can't split an `OP_REPEAT`
+    from its `OP_END` though), and `view` exposes the records as a
+    `memoryview`. Iterating yields the same 2-tuples as `str2keys`, for
+    compatibility, and `len` is their number, as for `KeyProgram`.
+    """
+
+    __slots__ = (
+        "_segments",
+        "_view",
+        "_length"
+    )
+
+    def __init__(self, data=b''):
+        """
+        `data` : bytes-like
+            Packed records, as built by `_pack_events`.
+        """
+        view = memoryview(data).cast('B')
+        if len(view) % _PACKED_EVENT.size:
+            raise ValueError("data size is not a multiple of the record size")
+        self._segments = (view,) if len(view) else ()
+        self._view = view
+        self._length = None
+
+    @classmethod
+    def from_keys(cls, keys, layout: Layout) -> 'KeyEvents':
+        """
+        Packs 2-tuples and `KeyRepeat`, such as the ones of a `KeyProgram`.
+        """
+        return cls(_pack_events(keys, layout))
+
+    @classmethod
+    def _from_segments(cls, segments) -> 'KeyEvents':
+        events = cls.__new__(cls)
+        events._segments = tuple(segments)
+        events._view = None if len(events._segments) > 1 else \
+            (events._segments[0] if events._segments else memoryview(b''))
+        events._length = None
+        return events
+
+    @property
+    def view(self) -> memoryview:
+        """
+        The records as a single, read-only `memoryview`. Sequences made
+        of several buffers (see `__add__`) are joined on first access.
+        """
+        if self._view is None:
+            self._view = memoryview(b''.join(self._segments))
+        return self._view.toreadonly()
+
+    @property
+    def record_count(self) -> int:
+        """
+        The number of records, repeats not expanded.
+        """
+        return sum(len(segment) for segment in self._segments) // _PACKED_EVENT.size
+
+    def __len__(self):
+        # counted as `__iter__` yields them: repeats expanded, a run of
+        # unicode characters being a single 2-tuple
+        if self._length is None:
+            length = 0
+            previous_op = None
+            for record in self.records():
+                op = record[0]
+                if op != OP_UNICODE or previous_op != OP_UNICODE:
+                    length += 1
+                previous_op = op
+            self._length = length
+        return self._length
+
+    def __getitem__(self, index):
+        size = _PACKED_EVENT.size
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.record_count)
+            if step != 1:
+                raise ValueError("KeyEvents slices can't have a step")
+            segments = []
+            start *= size
+            stop *= size
+            for segment in self._segments:
+                if start < len(segment) and stop > 0:
+                    segments.append(segment[max(start, 0):stop])
+                start -= len(segment)
+                stop -= len(segment)
+            _check_repeats(segments)
+            return KeyEvents._from_segments(segments)
+
+        length = self.record_count
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("KeyEvents index out of range")
+        index *= size
+        for segment in self._segments:
+            if index < len(segment):
+                return KeyEvent._make(_PACKED_EVENT.unpack_from(segment, index))
+            index -= len(segment)
+
+    def __add__(self, other):
+        if not isinstance(other, KeyEvents):
+            return NotImplemented
+        return KeyEvents._from_segments(self._segments + other._segments)
+
+    def __eq__(self, other):
+        if not isinstance(other, KeyEvents):
+            return NotImplemented
+        return self.view == other.view
+
+    def __bytes__(self):
+        return b''.join(self._segments)
+
+    def __repr__(self):
+        return '<KeyEvents: {} records>'.format(self.record_count)
+
+    def records(self):
+        """
+        Iterates over the records as tuples, expanding the repeats.
+        """
+        view = self.view
+        unpack_from = _PACKED_EVENT.unpack_from
+        size = _PACKED_EVENT.size
+        end = len(view)
+        pos = 0
+        repeats = []  # [position of the first repeated record, remaining count]
+
+        while pos < end:
+            record = unpack_from(view, pos)
+            pos += size
+            op = record[0]
+            if op == OP_REPEAT:
+                if record[5]:
+                    repeats.append([pos, record[5]])
+                else:
+                    depth = 1
+                    while depth and pos < end:
+                        depth += {OP_REPEAT: 1, OP_END: -1}.get(view[pos], 0)
+                        pos += size
+            elif op == OP_END:
+                if repeats:
+                    repeats[-1][1] -= 1
+                    if repeats[-1][1]:
+                        pos = repeats[-1][0]
+                    else:
+                        repeats.pop()
+            else:
+                yield record
+
+    def __iter__(self):
+        units = array('H')
+        for op, flags, vk, scan, _, payload in self.records():
+            if op == OP_UNICODE:
+                units.append(payload)
+                continue
+            if units:
+                yield units.tobytes().decode(_UTF16, 'surrogatepass'), True
+                del units[:]
+
+            if op == OP_KEY_DOWN:
+                yield vk, True
+            elif op == OP_KEY_UP:
+                yield vk, False
+            elif op == OP_PAUSE:
+                yield None, payload / 1e9
+        if units:
+            yield units.tobytes().decode(_UTF16, 'surrogatepass'), True
+
+
+def _key_input(vk, scan, flags) -> INPUT:
+    return INPUT(INPUT_KEYBOARD, _INPUTunion(ki=KEYBDINPUT(vk, scan, flags, 0, None)))
+
+
+_INPUT_SIZE = ctypes.sizeof(INPUT)
+
+def _fields_struct(*fields) -> struct.Struct:
+    """
+    Returns a `struct.Struct` packing the given ``(offset, ctypes type)``
+    fields, skipping whatever lies between them.
+    """
+    fmt = '='
+    pos = 0
+    for offset, ctype in fields:
+        size = ctypes.sizeof(ctype)
+        fmt += '{}x{}'.format(offset - pos, {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}[size])
+        pos = offset + size
+    return struct.Struct(fmt)
+
+
+# the fields of a keyboard `INPUT` that we fill: type, then `KEYBDINPUT`'s
+# wVk, wScan and dwFlags. time and dwExtraInfo are left to 0.
+_KEY_INPUT = _fields_struct(
+    (INPUT.type.offset, DWORD),
+    (INPUT.union.offset + _INPUTunion.ki.offset + KEYBDINPUT.wVk.offset, WORD),
+    (INPUT.union.offset + _INPUTunion.ki.offset + KEYBDINPUT.wScan.offset, WORD),
+    (INPUT.union.offset + _INPUTunion.ki.offset + KEYBDINPUT.dwFlags.offset, DWORD))
+
+
+class _InputBuffer:
+    """
+    Grow-only array of `INPUT` that the player fills in place and hands
+    over to `Backend.send`, without creating any ctypes object per event.
+    """
+
+    __slots__ = (
+        "inputs",
+        "view",
+        "size",
+        "count"
+    )
+
+    def __init__(self, size=MAX_BATCH_SIZE):
+        self.inputs = (INPUT * size)()
+        self.view = memoryview(self.inputs).cast('B')
+        self.size = size
+        self.count = 0
+
+    def _grow(self, needed):
+        size = self.size
+        while size < needed:
+            size *= 2
+        inputs = (INPUT * size)()
+        ctypes.memmove(inputs, self.inputs, self.count * _INPUT_SIZE)
+        self.inputs = inputs
+        self.view = memoryview(inputs).cast('B')
+        self.size = size
+
+    def add_key(self, vk, scan, flags):
+        if self.count == self.size:
+            self._grow(self.count + 1)
+        _KEY_INPUT.pack_into(self.view, self.count * _INPUT_SIZE, INPUT_KEYBOARD, vk, scan, flags)
+        self.count += 1
+
+    def add_unicode(self, text):
+        """
+        Adds the events typing `text` through ``KEYEVENTF_UNICODE``: a down
+        and an up event per UTF-16 code unit, surrogate pairs being sent
+        as two units.
+        """
+        units = memoryview(text.encode(_UTF16, 'surrogatepass')).cast('H')
+        if self.count + 2 * len(units) > self.size:
+            self._grow(self.count + 2 * len(units))
+
+        pack_into = _KEY_INPUT.pack_into
+        view = self.view
+        offset = self.count * _INPUT_SIZE
+        for unit in units:
+            pack_into(view, offset, INPUT_KEYBOARD, 0, unit, KEYEVENTF_UNICODE)
+            pack_into(view, offset + _INPUT_SIZE, INPUT_KEYBOARD, 0, unit, KEYEVENTF_UNICODE | KEYEVENTF_KEYUP)
+            offset += 2 * _INPUT_SIZE
+        self.count += 2 * len(units)
+
+    def add_inputs(self, data):
+        """
+        Copies raw `INPUT` structures, such as `Layout.char_inputs`.
+        """
+        count = len(data) // _INPUT_SIZE
+        if self.count + count > self.size:
+            self._grow(self.count + count)
+        offset = self.count * _INPUT_SIZE
+        self.view[offset:offset + len(data)] = data
+        self.count += count
+
+    def add_text(self, text, layout: Layout):
+        """
+        Adds the events typing `text`, copied from the layout's
+        per-character templates.
+        """
+        table = layout._char_inputs
+        try:
+            data = b''.join([table[c] for c in text])
+        except KeyError:
+            char_inputs = layout.char_inputs
+            data = b''.join([char_inputs(c) for c in text])
+        self.add_inputs(data)
+
+    def flush(self, backend):
+        if self.count:
+            metrics = _metrics
+            if metrics is None:
+                backend.send(self.inputs, self.count)
+            else:
+                start = time.perf_counter()
+                backend.send(self.inputs, self.count)
+                metrics.batch(self.count, time.perf_counter() - start)
+            self.count = 0
+
+
+# characters typed per `Backend.send` call by `Backend.type_text`: a
+# character is at most 4 events (modifier and key, down and up)
+_TEXT_CHUNK_SIZE = MAX_BATCH_SIZE // 4
+
+# per thread stacks of free `_InputBuffer`
+_buffer_pool = local()
+
+
+def _acquire_buffer() -> _InputBuffer:
+    try:
+        return _buffer_pool.free.pop()
+    except AttributeError:
+        _buffer_pool.free = []
+    except IndexError:
+        pass
+    return _InputBuffer()
+
+
+def _release_buffer(buffer: _InputBuffer):
+    buffer.count = 0
+    _buffer_pool.free.append(buffer)
+
+
+class Backend:
+    """
+    Receives the keyboard events to inject.
+
+    Subclasses implement `send` and `toggle_numlock`, the other methods
+    being built on top of `send`. Backends that can play a whole packed
+    sequence on their own (see `_pack_events`) set `native` and
+    implement `play_packed`.
+    """
+
+    __slots__ = ()
+
+    native = False
+
+    def play_packed(self, packed, pause) -> typing.Tuple[int, int, float, float]:
+        """
+        Plays packed events, pausing `pause` seconds between key
+        combinations. Returns the number of events sent, of waits, and
+        the total and maximum lateness of the waits in seconds.
+        """
+        raise NotImplementedError
+
+    def send(self, inputs, count):
+        """
+        Injects the first `count` structures of `inputs`, an array of
+        `INPUT`.
+        """
+        raise NotImplementedError
+
+    def toggle_numlock(self, turn_on) -> bool:
+        """
+        Turns NUMLOCK on or off and returns whether it was originally on.
+        """
+        raise NotImplementedError
+
+    def restore_numlock(self):
+        """
+        Turns NUMLOCK back on after `toggle_numlock` turned it off, by
+        pressing it unconditionally: the keyboard state `toggle_numlock`
+        reads is per thread, and may not have caught up yet.
+        """
+        self.send_all([_key_input(VK_NUMLOCK, 0x45, KEYEVENTF_EXTENDEDKEY),
+                       _key_input(VK_NUMLOCK, 0x45, KEYEVENTF_EXTENDEDKEY | KEYEVENTF_KEYUP)])
+
+    def send_all(self, inputs):
+        """
+        Injects a list of `INPUT` structures, in a single batch.
+        """
+        count = len(inputs)
+        if count:
+            self.send((INPUT * count)(*inputs), count)
+
+    def press(self, vk, scan=0):
+        self._send_key(vk, scan, 0)
+
+    def release(self, vk, scan=0):
+        self._send_key(vk, scan, KEYEVENTF_KEYUP)
+
+    def _send_key(self, vk, scan, flags):
+        buffer = _acquire_buffer()
+        try:
+            buffer.add_key(vk, scan, flags)
+            buffer.flush(self)
+        finally:
+            _release_buffer(buffer)
+
+    def type_text(self, text, layout: Layout):
+        """
+        Types `text` as fast as possible, without any pause between the
+        characters, from the layout's per-character `INPUT` templates
+        (see `Layout.char_inputs`).
+        """
+        buffer = _acquire_buffer()
+        try:
+            for start in range(0, len(text), _TEXT_CHUNK_SIZE):
+                buffer.add_text(text[start:start + _TEXT_CHUNK_SIZE], layout)
+                buffer.flush(self)
+        finally:
+            _release_buffer(buffer)
+
+    def unicode(self, text):
+        buffer = _acquire_buffer()
+        try:
+            buffer.add_unicode(text)
+            buffer.flush(self)
+        finally:
+            _release_buffer(buffer)
+
+
+class User32Backend(Backend):
+    """
+    Injects the events into the system, through ``SendInput``.
+
+    Whole sequences are played by the ``_sendkeys`` extension, which
+    doesn't hold the GIL meanwhile.
+    """
+
+    __slots__ = ()
+
+    @property
+    def native(self) -> bool:
+        return hasattr(_load_sendkeys(), 'play')
+
+    def play_packed(self, packed, pause) -> typing.Tuple[int, int, float, float]:
+        sent, waits, total_error, max_error = _load_sendkeys().play(packed, round(pause * 1e9))
+        return sent, waits, total_error / 1e9, max_error / 1e9
+
+    def send(self, inputs, count):
+        _load_user32().SendInput(count, inputs, _INPUT_SIZE)
+
+    def toggle_numlock(self, turn_on) -> bool:
+        return bool(_load_sendkeys().toggle_numlock(turn_on))
+
+
+RecordedEvent = namedtuple('RecordedEvent', ('time', 'vk', 'scan', 'flags'))
+
+
+class RecordingBackend(Backend):
+    """
+    Keeps the events in memory instead of injecting them, timestamped
+    with `time.perf_counter`, for tests and benchmarks. The batches are
+    stored as received and only decoded on access.
+
+    `numlock` : bool
+        The simulated NUMLOCK state.
+    """
+
+    __slots__ = (
+        "_batches",
+        "numlock"
+    )
+
+    def __init__(self, numlock=False):
+        self._batches = []
+        self.numlock = numlock
+
+    def send(self, inputs, count):
+        self._batches.append((time.perf_counter(),
+                              ctypes.string_at(ctypes.addressof(inputs), count * _INPUT_SIZE)))
+
+    @property
+    def events(self) -> typing.List[RecordedEvent]:
+        """
+        The `RecordedEvent` received so far.
+        """
+        events = []
+        for now, data in self._batches:
+            for offset in range(0, len(data), _INPUT_SIZE):
+                _, vk, scan, flags = _KEY_INPUT.unpack_from(data, offset)
+                events.append(RecordedEvent(now, vk, scan, flags))
+        return events
+
+    @property
+    def batch_sizes(self) -> typing.List[int]:
+        """
+        The number of events of each `send` call.
+        """
+        return [len(data) // _INPUT_SIZE for _, data in self._batches]
+
+    def restore_numlock(self):
+        super().restore_numlock()
+        self.numlock = not self.numlock
+
+    def toggle_numlock(self, turn_on) -> bool:
+        was_on = self.numlock
+        if was_on != bool(turn_on):
+            self.send_all([_key_input(VK_NUMLOCK, 0x45, KEYEVENTF_EXTENDEDKEY),
+                           _key_input(VK_NUMLOCK, 0x45, KEYEVENTF_EXTENDEDKEY | KEYEVENTF_KEYUP)])
+            self.numlock = bool(turn_on)
+        return was_on
+
+    @property
+    def keystrokes(self) -> list:
+        """
+        What the recorded events type: a ``(vk, modifiers)`` per key
+        pressed, `modifiers` being the frozenset of the modifiers held
+        meanwhile. Modifiers only count when tapped on their own, once
+        released. Unicode events are reported with their UTF-16 code
+        unit as a one character string in place of `vk`. Event sequences
+        typing the same text have equal keystrokes.
+        """
+        keystrokes = []
+        held = set()
+        tapped = None  # the modifier pressed last, until another key is
+        for event in self.events:
+            if event.flags & KEYEVENTF_KEYUP:
+                held.discard(event.vk)
+                if event.vk == tapped:
+                    keystrokes.append((event.vk, frozenset(held)))
+                tapped = None
+            elif event.flags & KEYEVENTF_UNICODE:
+                keystrokes.append((chr(event.scan), frozenset(held)))
+                tapped = None
+            elif event.vk in MODIFIER_KEYS:
+                held.add(event.vk)
+                tapped = event.vk
+            else:
+                keystrokes.append((event.vk, frozenset(held)))
+                tapped = None
+        return keystrokes
+
+    def clear(self):
+        self._batches.clear()
+
+
+# where `SendKeys`, `playkeys` & co. send the keys unless told otherwise
+default_backend = User32Backend()
 
 
 def press(code, layout: Layout):
-    _send_event(code, 0, layout)
+    default_backend.press(*_key_codes(code, layout))
 
 
 def release(code, layout: Layout):
-    _send_event(code, 2, layout)
+    default_backend.release(*_key_codes(code, layout))
 
 
 # thanks to: https://github.com/boppreh/keyboard!
 def type_unicode(character):
     # This code and related structures are based on
     # http://stackoverflow.com/a/11910555/252218
-    inputs = []
-    surrogates = bytearray(character.encode('utf-16le'))
-    for i in range(0, len(surrogates), 2):
-        higher, lower = surrogates[i:i+2]
-        structure = KEYBDINPUT(0, (lower << 8) + higher, KEYEVENTF_UNICODE, 0, None)
-        inputs.append(INPUT(INPUT_KEYBOARD, _INPUTunion(ki=structure)))
-    nInputs = len(inputs)
-    LPINPUT = INPUT * nInputs
-    pInputs = LPINPUT(*inputs)
-    cbSize = c_int(ctypes.sizeof(INPUT))
-    SendInput(nInputs, pInputs, cbSize)
+    default_backend.unicode(character)
 
 
-def playkeys(keys, layout: Layout, pause=.05):
+def _play_steps(records, pause, backend: Backend):
+    """
+    Sends `records` (see `_PACKED_EVENT`, repeats expanded) to `backend`,
+    yielding the number of seconds to wait each time the playback has
+    to pause, and `None` after each full batch of `MAX_BATCH_SIZE`
+    events, for the caller to report progress or give way to others.
+
+    Every event between two pauses goes out in a single `Backend.send`
+    call. The `pause` is taken once a key combination is over, i.e.
+    once no key other than a modifier remains pressed, and before the
+    next key is pressed: the keys of a combination are never delayed.
+    """
+    buffer = _acquire_buffer()
+    held = set()  # pressed keys, modifiers excepted
+    pressed = {}  # all the pressed keys: vk -> (scan, flags)
+    pause_due = False
+    previous_op = None
+
+    try:
+        for op, flags, vk, scan, _, payload in records:
+            if op == OP_KEY_DOWN or op == OP_UNICODE:
+                # a run of unicode characters is typed as a whole
+                if pause_due and not (op == OP_UNICODE and previous_op == OP_UNICODE):
+                    pause_due = False
+                    if pause:
+                        buffer.flush(backend)
+                        yield pause
+                pause_due = False
+
+                if op == OP_UNICODE:
+                    buffer.add_key(0, payload, KEYEVENTF_UNICODE)
+                    buffer.add_key(0, payload, KEYEVENTF_UNICODE | KEYEVENTF_KEYUP)
+                    pause_due = not held
+                else:
+                    key_flags = KEYEVENTF_EXTENDEDKEY if flags & EVENT_EXTENDED else 0
+                    buffer.add_key(vk, scan, key_flags)
+                    pressed[vk] = scan, key_flags
+                    if not flags & EVENT_MODIFIER:
+                        held.add(vk)
+            elif op == OP_KEY_UP:
+                buffer.add_key(vk, scan, KEYEVENTF_KEYUP | (KEYEVENTF_EXTENDEDKEY if flags & EVENT_EXTENDED else 0))
+                pressed.pop(vk, None)
+                held.discard(vk)
+                pause_due = not held
+            elif op == OP_PAUSE:
+                buffer.flush(backend)
+                yield (pause if pause_due else 0) + payload / 1e9
+                pause_due = False
+            previous_op = op
+
+            if buffer.count >= MAX_BATCH_SIZE:
+                buffer.flush(backend)
+                yield None
+
+        buffer.flush(backend)
+    except GeneratorExit:
+        # stopped during a wait (interrupted, cancelled...): don't leave
+        # any key, such as a modifier, pressed.
+        for vk, (scan, flags) in pressed.items():
+            buffer.add_key(vk, scan, flags | KEYEVENTF_KEYUP)
+        buffer.flush(backend)
+        raise
+    finally:
+        _release_buffer(buffer)
+
+
+TimingReport = namedtuple('TimingReport', ('waits', 'mean_error', 'max_error', 'duration'))
+
+
+class Scheduler:
+    """
+    Paces the playback against absolute deadlines taken from
+    `time.perf_counter`: each wait is scheduled relative to the end of
+    the previous one rather than to whenever the call happens, so the
+    time spent sending keys and the sleep overshoots don't add up.
+
+    `spin` : float
+        How long before a deadline to stop sleeping and busy-wait
+        instead, sleeps being too coarse for sub-millisecond accuracy.
+    """
+
+    __slots__ = (
+        "spin",
+        "_start",
+        "_deadline",
+        "waits",
+        "total_error",
+        "max_error"
+    )
+
+    def __init__(self, spin=SPIN_THRESHOLD):
+        self.spin = spin
+        self._start = self._deadline = time.perf_counter()
+        self.waits = 0
+        self.total_error = 0.0
+        self.max_error = 0.0
+
+    def _next_deadline(self, seconds, now) -> float:
+        deadline = self._deadline + seconds
+
+        # don't catch up by sending keys back to back when running late
+        # by more than a whole wait, start over from now instead.
+        if now - deadline > seconds:
+            deadline = now + seconds
+        return deadline
+
+    def _reached(self, deadline):
+        error = time.perf_counter() - deadline
+        metrics = _metrics
+        if metrics is not None:
+            metrics.paused(deadline - self._deadline, error)
+        self._deadline = deadline
+        self.waits += 1
+        self.total_error += error
+        if error > self.max_error:
+            self.max_error = error
+
+    def wait(self, seconds):
+        """
+        Waits until `seconds` after the previous deadline.
+        """
+        now = time.perf_counter()
+        deadline = self._next_deadline(seconds, now)
+
+        remaining = deadline - now
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while time.perf_counter() < deadline:
+            pass
+
+        self._reached(deadline)
+
+    async def async_wait(self, seconds):
+        """
+        Same as `wait`, but awaits the event loop's timers instead of
+        blocking, and doesn't busy-wait.
+        """
+        import asyncio
+
+        now = time.perf_counter()
+        deadline = self._next_deadline(seconds, now)
+        # the loop's timers may fire slightly early; a zero or overdue
+        # wait still gives way to the other tasks.
+        await asyncio.sleep(max(deadline - now, 0))
+        now = time.perf_counter()
+        while now < deadline:
+            await asyncio.sleep(deadline - now)
+            now = time.perf_counter()
+
+        self._reached(deadline)
+
+    def report(self) -> TimingReport:
+        """
+        Returns how late, in seconds, the waits were on average and at
+        worst, and how long the playback has been running.
+        """
+        return TimingReport(self.waits,
+                            self.total_error / self.waits if self.waits else 0.0,
+                            self.max_error,
+                            time.perf_counter() - self._start)
+
+
+def playkeys(keys, layout: Layout=None, pause=.05, backend: Backend=None) -> TimingReport:
     """
     Simulates pressing and releasing one or more keys.
 
@@ -662,30 +2745,299 @@ def playkeys(keys, layout: Layout, pause=.05):
         where `down` is `True` when the key is being pressed
         and `False` when it's being released.
 
-        `keys` is returned from `str2keys`.
+        `keys` is returned from `str2keys`, or is a `KeyProgram`
+        or `KeyEvents`.
+    `layout` : Layout
+        The layout the keys were parsed with, not needed by a
+        `KeyProgram` or `KeyEvents`.
     `pause` : float
-        Number of seconds between releasing a key and pressing the
-        next one.
+        Number of seconds between releasing a key (or key combination)
+        and pressing the next one.
+    `backend` : Backend
+        Where to send the keys, defaults to `default_backend`.
+
+    Returns the `TimingReport` of the `Scheduler` that paced the keys.
+
+    `KeyEvents`, a `KeyProgram` or a list sent to a native backend (see
+    `Backend.play_packed`) are played outside of the interpreter, unless
+    metrics are enabled (see `enable_metrics`).
     """
-    def handle_flag(_flag, _callback):
-        if (_flag & Layout.REQUIRES_SHIFT) == Layout.REQUIRES_SHIFT:
-            _callback(VK_SHIFT)
-        elif (_flag & Layout.REQUIRES_ALT_GR) == Layout.REQUIRES_ALT_GR:
-            _callback(ALT_GR)
+    if backend is None:
+        backend = default_backend
+    # the metrics observe each batch and wait of the Python player
+    metrics = _metrics
+    native = backend.native and metrics is None
+
+    if isinstance(keys, KeyProgram):
+        events = keys.events
+    elif isinstance(keys, KeyEvents):
+        events = keys
+    else:
+        events = None
+        if layout is None:
+            layout = layout_cache.get()
+        if native and isinstance(keys, (list, tuple)):
+            events = KeyEvents.from_keys(keys, layout)
+
+    if native and events is not None:
+        start = time.perf_counter()
+        sent, waits, total_error, max_error = backend.play_packed(events.view, pause)
+        duration = time.perf_counter() - start
+        return TimingReport(waits, total_error / waits if waits else 0.0, max_error, duration)
+
+    scheduler = Scheduler()
+    records = events.records() if events is not None else _iter_records(keys, layout)
+    steps = _play_steps(records, pause, backend)
+    try:
+        for seconds in steps:
+            if seconds is not None:
+                scheduler.wait(seconds)
+    finally:
+        # releases the pressed keys if interrupted
+        steps.close()
 
-    for (vk, arg) in keys:
-        if vk:
-            if type(vk) is str:
-                type_unicode(vk)
+    report = scheduler.report()
+    if metrics is not None:
+        metrics.played(report.duration)
+    return report
+
+
+Progress = namedtuple('Progress', ('events', 'report'))
+
+
+class _CountingBackend(Backend):
+    """
+    Forwards the events to another backend, counting them.
+    """
+
+    __slots__ = (
+        "backend",
+        "sent"
+    )
+
+    def __init__(self, backend: Backend):
+        self.backend = backend
+        self.sent = 0
+
+    def send(self, inputs, count):
+        self.backend.send(inputs, count)
+        self.sent += count
+
+    def toggle_numlock(self, turn_on) -> bool:
+        return self.backend.toggle_numlock(turn_on)
+
+    def restore_numlock(self):
+        self.backend.restore_numlock()
+
+
+async def aplaykeys(keys, layout: Layout=None, pause=.05, backend: Backend=None):
+    """
+    Same as `playkeys`, but awaits the event loop's timers between the
+    keys instead of blocking (see `Scheduler.async_wait`), always
+    playing the keys from Python.
+
+    This is an async iterator of the `Progress` of the playback: the
+    number of events sent so far and the current `TimingReport`, after
+    each batch of events and once done.
+
+    If cancelled, or closed before the end, the keys still pressed at
+    that point (modifiers included) are released.
+    """
+    import asyncio
+
+    if backend is None:
+        backend = default_backend
+    counter = _CountingBackend(backend)
+
+    if isinstance(keys, KeyProgram):
+        records = keys.events.records()
+    elif isinstance(keys, KeyEvents):
+        records = keys.records()
+    else:
+        if layout is None:
+            layout = layout_cache.get()
+        records = _iter_records(keys, layout)
+
+    scheduler = Scheduler()
+    steps = _play_steps(records, pause, counter)
+    try:
+        for seconds in steps:
+            yield Progress(counter.sent, scheduler.report())
+            if seconds is None:
+                # a long macro without pauses mustn't hold the loop
+                await asyncio.sleep(0)
             else:
-                if arg:
-                    press(vk, layout)
-                else:
-                    release(vk, layout)
-                    if pause:  # pause after key up
-                        time.sleep(pause)
-        else:
-            time.sleep(arg)
+                await scheduler.async_wait(seconds)
+    finally:
+        steps.close()
+
+    report = scheduler.report()
+    metrics = _metrics
+    if metrics is not None:
+        metrics.played(report.duration)
+    yield Progress(counter.sent, report)
+
+
+class KeySession:
+    """
+    Sends keys to the current window over several calls, resolving the
+    layout and turning off `NUMLOCK` once for all of them. The original
+    state of `NUMLOCK` is restored on exit.
+
+    example::
+
+        with KeySession() as session:
+            session.send("Hello{SPACE}")
+            session.type_text("World!")
+            session.combo("CTRL", "s")
+
+    The arguments are the ones of `SendKeys`, which are the defaults of
+    `send`.
+    """
+
+    __slots__ = (
+        "_layout",
+        "pause",
+        "with_spaces",
+        "with_tabs",
+        "with_newlines",
+        "turn_off_numlock",
+        "backend",
+        "optimize",
+        "_restore_numlock"
+    )
+
+    def __init__(self,
+                 layout: Layout=None,
+                 pause=0.05,
+                 with_spaces=False,
+                 with_tabs=False,
+                 with_newlines=False,
+                 turn_off_numlock=True,
+                 backend: Backend=None,
+                 optimize=False):
+        self._layout = layout
+        self.pause = pause
+        self.with_spaces = with_spaces
+        self.with_tabs = with_tabs
+        self.with_newlines = with_newlines
+        self.turn_off_numlock = turn_off_numlock
+        self.backend = default_backend if backend is None else backend
+        self.optimize = optimize
+        self._restore_numlock = False
+
+    @property
+    def layout(self) -> Layout:
+        """
+        The layout of the session, defaulting to the (cached) layout of
+        the foreground window when first needed. A layout identifier is
+        looked up in `layout_registry`.
+        """
+        if self._layout is None:
+            self._layout = layout_cache.get()
+        elif not isinstance(self._layout, Layout):
+            self._layout = layout_registry.get(self._layout)
+        return self._layout
+
+    def __enter__(self) -> 'KeySession':
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        # certain keystrokes don't seem to behave the same way if NUMLOCK
+        # is on (for example, ^+{LEFT}), so turn NUMLOCK off, if it's on
+        # and restore its original state when done.
+        if self.turn_off_numlock:
+            self._restore_numlock = self.backend.toggle_numlock(False) or self._restore_numlock
+
+    def close(self):
+        if self._restore_numlock:
+            self._restore_numlock = False
+            self.backend.restore_numlock()
+
+    def send(self, keys, pause=None) -> TimingReport:
+        """
+        Sends `keys`: a string of keys, a `KeyProgram` or a file object
+        or an iterable of strings, see `SendKeys`. `pause` defaults to the
+        pause of the session.
+
+        Returns the `TimingReport` of the playback, see `playkeys`.
+        """
+        if pause is None:
+            pause = self.pause
+        keys = self._keys(keys)
+        layout = keys.layout if isinstance(keys, KeyProgram) else self.layout
+        return playkeys(keys, layout, pause, self.backend)
+
+    def _keys(self, keys):
+        """
+        Parses a string of keys with the session's settings, or a stream
+        if `keys` isn't a `KeyProgram`.
+        """
+        if isinstance(keys, KeyProgram):
+            return keys
+        if isinstance(keys, str):
+            return program_cache.get(keys, self.layout, self.with_spaces, self.with_tabs,
+                                     self.with_newlines, self.optimize)
+        return iter_keys(keys, self.layout, self.with_spaces, self.with_tabs, self.with_newlines)
+
+    def aprogress(self, keys, pause=None):
+        """
+        Sends `keys` like `send` without blocking the event loop, see
+        `aplaykeys`: an async iterator of the `Progress` of the playback.
+        """
+        if pause is None:
+            pause = self.pause
+        keys = self._keys(keys)
+        layout = keys.layout if isinstance(keys, KeyProgram) else self.layout
+        return aplaykeys(keys, layout, pause, self.backend)
+
+    async def asend(self, keys, pause=None) -> TimingReport:
+        """
+        Same as `send`, without blocking the event loop (see `aplaykeys`).
+        If cancelled, the keys still pressed are released.
+        """
+        progress = None
+        async for progress in self.aprogress(keys, pause):
+            pass
+        return progress.report
+
+    async def __aenter__(self) -> 'KeySession':
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.__exit__(exc_type, exc_value, traceback)
+
+    def type_text(self, text):
+        """
+        Types `text` as is, braces included and without pausing between
+        the characters, see `Backend.type_text`.
+        """
+        self.backend.type_text(text, self.layout)
+
+    def combo(self, *keys, pause=None) -> TimingReport:
+        """
+        Presses then releases the given keys, as ``{KEY+KEY}`` does: each
+        key is a character or a key name of `CODES`.
+
+        example::
+
+            session.combo("CTRL", "ALT", "DELETE")
+        """
+        if pause is None:
+            pause = self.pause
+
+        layout = self.layout
+        keys_down = []
+        keys_up = []
+        for key in keys:
+            vk = layout.lookup(key)
+            _append_key(vk, keys_down, layout, True, False)
+            _append_key(vk, keys_up, layout, False, True)
+        return playkeys(keys_down + keys_up, layout, pause, self.backend)
 
 
 def SendKeys(keys,
@@ -694,12 +3046,20 @@ def SendKeys(keys,
              with_spaces=False,
              with_tabs=False,
              with_newlines=False,
-             turn_off_numlock=True):
+             turn_off_numlock=True,
+             backend: Backend=None,
+             optimize=False):
     """
     Sends keys to the current window.
 
     `keys` : str
-        A string of keys.
+        A string of keys, or a `KeyProgram` (in which case the parsing
+        flags are ignored), or a file object or an iterable of strings
+        which is parsed while the keys are sent, see `iter_keys`.
+    `layout` : Layout
+        The layout to translate the keys with, defaults to the
+        (cached) layout of the foreground window. It may be given by
+        identifier, such as ``"de-DE"``, see `LayoutRegistry`.
     `pause` : float
         The number of seconds to wait between sending each key
         or key combination.
@@ -711,34 +3071,481 @@ def SendKeys(keys,
         Whether to treat newlines as ``{ENTER}``. If `False`, newlines are ignored.
     `turn_off_numlock` : bool
         Whether to turn off `NUMLOCK` before sending keys.
+    `backend` : Backend
+        Where to send the keys, defaults to `default_backend`.
+    `optimize` : bool
+        Whether to drop the redundant events of a string of keys, see
+        `optimize_keys`.
 
     example::
 
         SendKeys("Hello{SPACE}World!")
 
     would result in ``"Hello World!"``
+
+    Returns the `TimingReport` of the playback, see `playkeys`.
+
+    Scripts sending keys many times should rather use a `KeySession`,
+    which turns `NUMLOCK` off once for all of them.
     """
+    session = KeySession(layout, pause, with_spaces, with_tabs, with_newlines,
+                         turn_off_numlock, backend, optimize)
 
-    if layout is None:
-        layout = _setup_tables()
+    # parse a string before touching NUMLOCK, in case it's invalid
+    if isinstance(keys, str):
+        keys = program_cache.get(keys, session.layout, with_spaces, with_tabs, with_newlines, optimize)
+
+    with session:
+        return session.send(keys)
+
+
+DispatcherStats = namedtuple('DispatcherStats', ('depth', 'submitted', 'completed', 'mean_wait', 'max_wait'))
+
+
+class Dispatcher:
+    """
+    Plays the key sequences submitted from any thread on a single worker
+    thread, one whole sequence after the other: the events of
+    concurrent sequences never interleave.
 
-    restore_numlock = False
+    Sequences are played by order of `priority` (highest first), then of
+    submission. An urgent sequence thus goes before the ones waiting,
+    but never interrupts the one being played.
+
+    example::
+
+        future = dispatcher.submit("Hello{ENTER}")
+        future.result()  # the TimingReport of the playback
+
+    The worker thread is started on the first submission. It plays the
+    keys through a `KeySession`, which is open until `shutdown`.
+    """
+
+    __slots__ = (
+        "session",
+        "_queue",
+        "_thread",
+        "_count",
+        "_shutdown",
+        "submitted",
+        "started",
+        "completed",
+        "total_wait",
+        "max_wait",
+        "lock"
+    )
+
+    def __init__(self, session: KeySession=None):
+        """
+        `session` : KeySession
+            The session, and thus the settings, of the playback. Defaults
+            to a `KeySession` with the default settings.
+        """
+        self.session = KeySession() if session is None else session
+        self._queue = PriorityQueue()
+        self._thread = None
+        self._count = 0
+        self._shutdown = False
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.lock = Lock()
+
+    def submit(self, keys, pause=None, priority=0) -> 'Future':
+        """
+        Queues `keys` (see `KeySession.send`) and returns the `Future` of
+        its `TimingReport`. Strings are parsed right away, so that syntax
+        errors are raised here, with the session's layout or else the
+        active one.
+        """
+        from concurrent.futures import Future
+
+        if isinstance(priority, bool) or not isinstance(priority, (int, float)):
+            raise TypeError("priority must be a number, not {}".format(type(priority).__name__))
+        if priority != priority:
+            raise ValueError("priority can't be NaN")
+
+        if isinstance(keys, str):
+            session = self.session
+            # not `session.layout`, which would stick to the first layout
+            # active for as long as the dispatcher lives
+            keys = compile_keys(keys, session.layout if session._layout is not None else None,
+                                session.with_spaces, session.with_tabs, session.with_newlines,
+                                session.optimize)
+
+        future = Future()
+        with self.lock:
+            if self._shutdown:
+                raise RuntimeError("can't submit keys after shutdown")
+            # restarted if it stopped on an error opening the session
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name='SendKeys dispatcher', daemon=True)
+                self._thread.start()
+            self._count += 1
+            self.submitted += 1
+            self._queue.put((-priority, self._count, time.perf_counter(), future, keys, pause))
+        return future
+
+    def _run(self):
+        try:
+            self.session.open()
+        except BaseException as e:
+            self._fail(e)
+            return
+        try:
+            self._play()
+        finally:
+            self.session.close()
+
+    def _play(self):
+        while True:
+            _, _, submitted, future, keys, pause = self._queue.get()
+            if future is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            wait = time.perf_counter() - submitted
+            with self.lock:
+                self.started += 1
+                self.total_wait += wait
+                if wait > self.max_wait:
+                    self.max_wait = wait
+
+            try:
+                future.set_result(self.session.send(keys, pause))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.completed += 1
+
+    def _fail(self, error):
+        """
+        Fails the sequences waiting with `error`, raised opening the
+        session, and lets the next submission start a new worker.
+        """
+        with self.lock:
+            self._thread = None
+            while not self._queue.empty():
+                _, _, _, future, _, _ = self._queue.get_nowait()
+                if future is not None and future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+                    self.completed += 1
+
+    def stats(self) -> DispatcherStats:
+        """
+        Returns the number of sequences waiting, of sequences submitted
+        and completed, and how long, in seconds, the sequences waited
+        before being played on average and at worst.
+        """
+        with self.lock:
+            return DispatcherStats(self._queue.qsize(), self.submitted, self.completed,
+                                   self.total_wait / self.started if self.started else 0.0,
+                                   self.max_wait)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker once the sequences already submitted are
+        played, restoring `NUMLOCK`.
+        """
+        with self.lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            thread = self._thread
+            if thread is not None:
+                # after every sequence, whatever its priority
+                self._queue.put((float('inf'), 0, 0, None, None, None))
+        if wait and thread is not None:
+            thread.join()
+
+    def __enter__(self) -> 'Dispatcher':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+
+# shared by `submit_keys`, its thread is only started when first used
+dispatcher = Dispatcher()
+
+
+def submit_keys(keys, pause=None, priority=0) -> 'Future':
+    """
+    Queues `keys` to be played by the shared `dispatcher`, see
+    `Dispatcher.submit`.
+    """
+    return dispatcher.submit(keys, pause, priority)
+
+
+async def async_send_keys(keys,
+                          layout: Layout=None,
+                          pause=0.05,
+                          with_spaces=False,
+                          with_tabs=False,
+                          with_newlines=False,
+                          turn_off_numlock=True,
+                          backend: Backend=None,
+                          optimize=False) -> TimingReport:
+    """
+    Same as `SendKeys`, but awaits the event loop's timers between the
+    keys instead of blocking the thread, see `KeySession.asend`.
+    """
+    session = KeySession(layout, pause, with_spaces, with_tabs, with_newlines,
+                         turn_off_numlock, backend, optimize)
+
+    # parse a string before touching NUMLOCK, in case it's invalid
+    if isinstance(keys, str):
+        keys = program_cache.get(keys, session.layout, with_spaces, with_tabs, with_newlines, optimize)
+
+    async with session:
+        return await session.asend(keys)
+
+
+# a frame is the size of its payload, as a big endian uint32, followed by
+# the payload: a UTF-8 encoded JSON object.
+_FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+_LOOPBACK_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+def _parse_address(address) -> tuple:
+    """
+    Returns the socket family and address of ``unix:PATH``,
+    ``HOST:PORT`` or ``PORT``, `HOST` being a loopback address.
+    """
+    import socket
+
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+
+    host, _, port = address.rpartition(':')
+    host = host.strip('[]') or 'localhost'
+    if host not in _LOOPBACK_HOSTS:
+        raise ValueError("'{}' is not a loopback address".format(host))
     try:
-        # read keystroke keys into a list of 2 tuples [(key,up),]
-        _keys = str2keys(keys, layout, with_spaces, with_tabs, with_newlines)
+        port = int(port)
+    except ValueError:
+        raise ValueError("invalid port: '{}'".format(port))
+    return socket.AF_INET6 if host == '::1' else socket.AF_INET, (host, port)
 
-        # certain keystrokes don't seem to behave the same way if NUMLOCK
-        # is on (for example, ^+{LEFT}), so turn NUMLOCK off, if it's on
-        # and restore its original state when done.
-        if turn_off_numlock:
-            restore_numlock = toggle_numlock(False)
 
-        # "play" the keys to the active window
-        playkeys(_keys, layout, pause)
-    finally:
-        if restore_numlock and turn_off_numlock:
-            key_down(CODES['NUMLOCK'])
-            key_up(CODES['NUMLOCK'])
+def _read_frame(f):
+    """
+    Reads a frame from the file object `f`, returns `None` at the end
+    of the stream.
+    """
+    header = f.read(_FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _FRAME_HEADER.size:
+        raise EOFError("truncated frame")
+    size, = _FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError("frame of {} bytes is too large".format(size))
+    payload = f.read(size)
+    if len(payload) < size:
+        raise EOFError("truncated frame")
+
+    import json
+    return json.loads(payload.decode('utf-8'))
+
+
+def _write_frame(f, message):
+    import json
+
+    payload = json.dumps(message).encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError("frame of {} bytes is too large".format(len(payload)))
+    f.write(_FRAME_HEADER.pack(len(payload)) + payload)
+    f.flush()
+
+
+def _request_number(request, name, default, minimum=None):
+    """
+    Returns the number `name` of a request, rejecting anything else (JSON
+    booleans included) before it gets played.
+    """
+    value = request.get(name, default)
+    if value is default:
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+        raise TypeError("'{}' must be a number".format(name))
+    if minimum is not None and value < minimum:
+        raise ValueError("'{}' must be at least {}".format(name, minimum))
+    return value
+
+
+def _serve_request(request, dispatcher: Dispatcher, log) -> dict:
+    """
+    Plays a request received by `serve` and returns the response.
+    """
+    received = time.perf_counter()
+    try:
+        keys = request['keys']
+        if not isinstance(keys, str):
+            raise TypeError("'keys' must be a string")
+        pause = _request_number(request, 'pause', None, 0)
+        priority = _request_number(request, 'priority', 0)
+        program = compile_keys(keys, None,
+                               bool(request.get('with_spaces')),
+                               bool(request.get('with_tabs')),
+                               bool(request.get('with_newlines')))
+        report = dispatcher.submit(program, pause, priority).result()
+    except Exception as e:
+        # the invalid requests as well as the playback errors, such as an
+        # `OSError` of the backend: the client gets an answer either way
+        return {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+    latency = time.perf_counter() - received
+    if log is not None:
+        print('%d events in %.1f ms, %.1f ms of which playing'
+              % (len(program), latency * 1000, report.duration * 1000), file=log)
+    return {'ok': True, 'latency': latency, 'queued': latency - report.duration,
+            'report': report._asdict()}
+
+
+def serve(address, pause=0.05, dispatcher: Dispatcher=None, log=sys.stderr):
+    """
+    Plays the key sequences received on `address` (see `KeyClient`) until
+    interrupted, keeping the layouts and the compiled programs cached
+    between requests.
+
+    `address` : str
+        ``unix:PATH`` for a Unix socket, or ``[HOST:]PORT`` for a TCP
+        socket, `HOST` being a loopback address (``localhost`` by
+        default).
+    `pause` : float
+        The default pause of the requests.
+    `dispatcher` : Dispatcher
+        Plays the sequences of all the clients, one after the other.
+        Defaults to a new `Dispatcher`, `NUMLOCK` being kept off as long
+        as the server runs.
+    `log` : file
+        Where to write the latency of each request, if not `None`.
+
+    Clients send frames, each a 4 bytes big endian size followed by as
+    many bytes of UTF-8 encoded JSON. A request holds the string of
+    ``keys`` and optionally the ``pause``, ``priority``,
+    ``with_spaces``, ``with_tabs`` and ``with_newlines`` arguments. Each
+    is answered, in order, by a response holding ``ok`` and either the
+    ``error`` or the ``latency`` (seconds from the reception of the
+    request to the end of the playback), the time ``queued`` (parsing
+    and waiting for the other clients) and the ``report`` of the
+    playback (see `TimingReport`).
+    """
+    import os
+    import stat
+    import socket
+    import socketserver
+
+    family, server_address = _parse_address(address)
+    if dispatcher is None:
+        dispatcher = Dispatcher(KeySession(pause=pause))
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            while True:
+                try:
+                    request = _read_frame(self.rfile)
+                except (EOFError, ValueError) as e:
+                    _write_frame(self.wfile, {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)})
+                    break
+                if request is None:
+                    break
+                if not isinstance(request, dict):
+                    response = {'ok': False, 'error': 'TypeError: a request must be an object'}
+                else:
+                    response = _serve_request(request, dispatcher, log)
+                _write_frame(self.wfile, response)
+
+    if family == socket.AF_UNIX:
+        base = socketserver.UnixStreamServer
+        # only replace the socket of a previous server, not any file
+        try:
+            mode = os.stat(server_address).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError("'{}' exists and isn't a socket".format(server_address))
+            os.unlink(server_address)
+    else:
+        base = socketserver.TCPServer
+
+    class Server(socketserver.ThreadingMixIn, base):
+        address_family = family
+        allow_reuse_address = True
+        daemon_threads = True
+
+    with dispatcher, Server(server_address, Handler) as server:
+        if log is not None:
+            print('serving on %s' % address, file=log)
+        try:
+            server.serve_forever()
+        finally:
+            if family == socket.AF_UNIX:
+                os.unlink(server_address)
+
+
+class KeyClient:
+    """
+    Sends key sequences to a `serve` process over a connection that is
+    kept open.
+
+    example::
+
+        with KeyClient("unix:/tmp/sendkeys.sock") as client:
+            client.send("Hello{ENTER}")
+    """
+
+    __slots__ = (
+        "_socket",
+        "_file"
+    )
+
+    def __init__(self, address):
+        import socket
+
+        family, address = _parse_address(address)
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(address)
+        except OSError:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile('rwb')
+
+    def send(self, keys, pause=None, priority=0,
+             with_spaces=False, with_tabs=False, with_newlines=False) -> dict:
+        """
+        Sends `keys` to the server and returns its response, once the
+        keys are played. See `SendKeys` for the arguments, `pause`
+        defaulting to the server's one.
+        """
+        request = {'keys': keys, 'priority': priority, 'with_spaces': with_spaces,
+                   'with_tabs': with_tabs, 'with_newlines': with_newlines}
+        if pause is not None:
+            request['pause'] = pause
+        _write_frame(self._file, request)
+        response = _read_frame(self._file)
+        if response is None:
+            raise EOFError("connection closed by the server")
+        return response
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self) -> 'KeyClient':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def usage():
@@ -746,12 +3553,17 @@ def usage():
     Writes help message to `stderr` and exits.
     """
     print("""\
-%(name)s [-h] [-d seconds] [-p seconds] [-f filename] or [string of keys]
+%(name)s [-h] [-d seconds] [-p seconds] [-c address] [-f filename] or [string of keys]
+%(name)s [-p seconds] -s address
+
+    -dN    or --delay=N     : N is seconds before starting
+    -pN    or --pause=N     : N is seconds between each key
+    -fNAME or --file=NAME   : NAME is filename containing keys to send
+    -sADDR or --serve=ADDR  : play the keys sent to ADDR, see below
+    -cADDR or --connect=ADDR: send the keys to the server on ADDR
+    -h     or --help        : show help message
 
-    -dN    or --delay=N   : N is seconds before starting
-    -pN    or --pause=N   : N is seconds between each key
-    -fNAME or --file=NAME : NAME is filename containing keys to send
-    -h     or --help      : show help message"""
+    ADDR is either unix:PATH or [HOST:]PORT, HOST being localhost"""
           % {'name': 'SendKeys.py'},
           file=sys.stderr)
     sys.exit(1)
@@ -774,19 +3586,26 @@ def main(args=None):
 
     try:
         opts, args = getopt.getopt(args,
-                                   "hp:d:f:", ["help", "pause", "delay", "file"])
+                                   "hp:d:f:s:c:",
+                                   ["help", "pause=", "delay=", "file=", "serve=", "connect="])
     except getopt.GetoptError:
         usage()
 
-    pause = 0
+    pause = None
     delay = 0
     filename = None
+    serve_address = None
+    connect_address = None
 
     for o, a in opts:
         if o in ('-h', '--help'):
             usage()
         elif o in ('-f', '--file'):
             filename = a
+        elif o in ('-s', '--serve'):
+            serve_address = a
+        elif o in ('-c', '--connect'):
+            connect_address = a
         elif o in ('-p', '--pause'):
             try:
                 pause = float(a)
@@ -800,18 +3619,42 @@ def main(args=None):
             except (ValueError, AssertionError) as e:
                 error('`delay` must be >= 0.0')
 
+    if serve_address is not None:
+        if filename is not None or args or connect_address is not None:
+            error("can't send keys while serving")
+        try:
+            serve(serve_address, pause or 0)
+        except ValueError as e:
+            error(str(e))
+        except KeyboardInterrupt:
+            pass
+        return
+
     time.sleep(delay)
 
     if filename is not None and args:
         error("can't pass both filename and string of keys on command-line")
+
+    if connect_address is not None:
+        try:
+            client = KeyClient(connect_address)
+        except ValueError as e:
+            error(str(e))
+        with client:
+            if filename:
+                with open(filename) as f:
+                    args = [f.read()]
+            for a in args:
+                response = client.send(a, pause)
+                if not response['ok']:
+                    print(response['error'], file=sys.stderr)
+                    sys.exit(1)
     elif filename:
-        f = open(filename)
-        keys = f.read()
-        f.close()
-        SendKeys(keys, pause)
+        with open(filename) as f:
+            SendKeys(f, pause=pause or 0)
     else:
         for a in args:
-            SendKeys(a, pause)
+            SendKeys(a, pause=pause or 0)
 
 
 if __name__ == '__main__':
@@ -10,8 +10,131 @@
 * $Id$
 */
 
+#define PY_SSIZE_T_CLEAN
 #include "Python.h"
+
+#ifdef _WIN32
 #include "windows.h"
+#include <mmsystem.h>
+
+#ifndef CREATE_WAITABLE_TIMER_HIGH_RESOLUTION
+#define CREATE_WAITABLE_TIMER_HIGH_RESOLUTION 0x00000002
+#endif
+#else
+/*
+ * Stub injector, so that the module (and the playback loop in
+ * particular) can be built and tested on other platforms: the events
+ * are recorded in memory instead, see `stub_events()`.
+ */
+#include <stdint.h>
+#include <string.h>
+#include <time.h>
+
+typedef unsigned char BYTE, byte, *LPBYTE;
+typedef unsigned short WORD;
+typedef uint32_t DWORD;
+typedef unsigned int UINT;
+typedef int BOOL;
+
+typedef struct {
+	WORD wVk;
+	WORD wScan;
+	DWORD dwFlags;
+	DWORD time;
+	uintptr_t dwExtraInfo;
+} KEYBDINPUT;
+
+typedef struct {
+	DWORD type;
+	union {
+		KEYBDINPUT ki;
+	};
+} INPUT;
+
+#define INPUT_KEYBOARD 1
+#define KEYEVENTF_EXTENDEDKEY 0x1
+#define KEYEVENTF_KEYUP 0x2
+#define KEYEVENTF_UNICODE 0x4
+#define VK_NUMLOCK 0x90
+
+#define STUB_LOG_SIZE 65536
+
+static KEYBDINPUT stub_log[STUB_LOG_SIZE];
+static Py_ssize_t stub_log_count = 0;
+
+static void
+stub_record(WORD vk, WORD scan, DWORD flags)
+{
+	if(stub_log_count < STUB_LOG_SIZE)
+	{
+		stub_log[stub_log_count].wVk = vk;
+		stub_log[stub_log_count].wScan = scan;
+		stub_log[stub_log_count].dwFlags = flags;
+		stub_log_count++;
+	}
+}
+
+static UINT
+SendInput(UINT count, INPUT* inputs, int size)
+{
+	UINT i;
+	for(i = 0; i < count; i++)
+		stub_record(inputs[i].ki.wVk, inputs[i].ki.wScan, inputs[i].ki.dwFlags);
+	return count;
+}
+
+static void
+keybd_event(BYTE vk, BYTE scan, DWORD flags, uintptr_t extra)
+{
+	stub_record(vk, scan, flags);
+}
+
+static UINT
+MapVirtualKeyA(UINT code, UINT map_type)
+{
+	return 0;
+}
+
+static BOOL
+GetKeyboardState(LPBYTE keys)
+{
+	memset(keys, 0, 256);
+	return 1;
+}
+
+static char stub_events_docs[] = "\
+stub_events() -> list \n\
+\n\
+Returns the (vk, scan, flags) events sent so far by the \n\
+stub injector and forgets them. \n\
+";
+
+static PyObject*
+stub_events(PyObject* self, PyObject* args)
+{
+	Py_ssize_t i;
+	PyObject* events = PyList_New(stub_log_count);
+
+	if(events == NULL)
+		return NULL;
+
+	for(i = 0; i < stub_log_count; i++)
+	{
+		PyObject* event = Py_BuildValue("(iik)",
+			stub_log[i].wVk, stub_log[i].wScan,
+			(unsigned long)stub_log[i].dwFlags);
+		if(event == NULL)
+		{
+			Py_DECREF(events);
+			return NULL;
+		}
+		PyList_SET_ITEM(events, i, event);
+	}
+	stub_log_count = 0;
+
+	return events;
+}
+#endif
 
 /* sends a key pressed event */
 static void
@@ -116,10 +239,440 @@ key_up(PyObject* self, PyObject* args)
 	return Py_BuildValue("");
 }
 
+/*
+ * Packed events, as built by SendKeys._pack_events: fixed-width records
+ * of 16 bytes, in native byte order.
+ */
+typedef struct {
+	unsigned char op;
+	unsigned char flags;
+	unsigned short vk;
+	unsigned short scan;
+	unsigned short reserved;
+	unsigned long long payload;
+} packed_event;
+
+#define OP_KEY_DOWN	1	/* vk, scan */
+#define OP_KEY_UP	2	/* vk, scan */
+#define OP_UNICODE	3	/* payload: UTF-16 code unit */
+#define OP_PAUSE	4	/* payload: nanoseconds */
+#define OP_REPEAT	5	/* payload: count, up to the matching OP_END */
+#define OP_END		6
+
+#define EVENT_EXTENDED	0x1
+#define EVENT_MODIFIER	0x2
+
+#define MAX_REPEAT_DEPTH 32
+#define BATCH_SIZE 256
+#define SPIN_NS 2000000LL	/* busy-wait the last 2 milliseconds */
+
+typedef struct {
+	Py_ssize_t start;
+	unsigned long long remaining;
+} repeat_frame;
+
+typedef struct {
+	INPUT inputs[BATCH_SIZE];
+	UINT count;
+	unsigned long long sent;
+	/* pressed keys, how they were pressed, and how many of them aren't
+	 * modifiers */
+	unsigned char down[256];
+	WORD down_scan[256];
+	DWORD down_flags[256];
+	int held;
+	/* scheduling */
+#ifdef _WIN32
+	HANDLE timer;	/* high resolution waitable timer, if available */
+	int timer_period;	/* whether timeBeginPeriod(1) is in effect instead */
+#endif
+	long long deadline;
+	unsigned long long waits;
+	long long total_error;
+	long long max_error;
+} player;
+
+static long long
+now_ns(void)
+{
+#ifdef _WIN32
+	static LARGE_INTEGER frequency = {0};
+	LARGE_INTEGER counter;
+
+	if(frequency.QuadPart == 0)
+		QueryPerformanceFrequency(&frequency);
+	QueryPerformanceCounter(&counter);
+	return (long long)((double)counter.QuadPart * 1e9 / (double)frequency.QuadPart);
+#else
+	struct timespec ts;
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (long long)ts.tv_sec * 1000000000LL + ts.tv_nsec;
+#endif
+}
+
+/*
+ * Sleep() alone rounds up to the system timer period (15.6 ms by
+ * default), far more than SPIN_NS absorbs: wait on a high resolution
+ * timer instead, or raise the timer resolution where there's none
+ * (before Windows 10 1803).
+ */
+static void
+player_open(player* p)
+{
+#ifdef _WIN32
+	p->timer = CreateWaitableTimerExW(NULL, NULL,
+		CREATE_WAITABLE_TIMER_HIGH_RESOLUTION, TIMER_ALL_ACCESS);
+	if(p->timer == NULL)
+		p->timer_period = timeBeginPeriod(1) == TIMERR_NOERROR;
+#endif
+	p->deadline = now_ns();
+}
+
+static void
+player_close(player* p)
+{
+#ifdef _WIN32
+	if(p->timer != NULL)
+		CloseHandle(p->timer);
+	if(p->timer_period)
+		timeEndPeriod(1);
+#endif
+}
+
+static void
+sleep_ns(player* p, long long ns)
+{
+#ifdef _WIN32
+	LARGE_INTEGER due;
+
+	if(p->timer != NULL)
+	{
+		/* relative, in 100 nanoseconds units */
+		due.QuadPart = -(ns / 100);
+		if(SetWaitableTimer(p->timer, &due, 0, NULL, NULL, FALSE))
+		{
+			WaitForSingleObject(p->timer, INFINITE);
+			return;
+		}
+	}
+	Sleep((DWORD)(ns / 1000000));
+#else
+	struct timespec ts;
+	ts.tv_sec = ns / 1000000000LL;
+	ts.tv_nsec = ns % 1000000000LL;
+	nanosleep(&ts, NULL);
+#endif
+}
+
+static void
+player_flush(player* p)
+{
+	if(p->count)
+	{
+		SendInput(p->count, p->inputs, sizeof(INPUT));
+		p->sent += p->count;
+		p->count = 0;
+	}
+}
+
+static void
+player_add(player* p, WORD vk, WORD scan, DWORD flags)
+{
+	INPUT* input;
+
+	if(p->count == BATCH_SIZE)
+		player_flush(p);
+
+	input = &p->inputs[p->count++];
+	memset(input, 0, sizeof(INPUT));
+	input->type = INPUT_KEYBOARD;
+	input->ki.wVk = vk;
+	input->ki.wScan = scan;
+	input->ki.dwFlags = flags;
+}
+
+/* waits until `ns` after the previous deadline, see SendKeys.Scheduler */
+static void
+player_wait(player* p, long long ns)
+{
+	long long now = now_ns();
+	long long deadline = p->deadline + ns;
+	long long error;
+
+	if(now - deadline > ns)
+		deadline = now + ns;
+
+	if(deadline - now > SPIN_NS)
+		sleep_ns(p, deadline - now - SPIN_NS);
+	while(now_ns() < deadline)
+		;
+
+	error = now_ns() - deadline;
+	p->deadline = deadline;
+	p->waits++;
+	p->total_error += error;
+	if(error > p->max_error)
+		p->max_error = error;
+}
+
+/* releases whatever is still pressed, the way it was pressed */
+static void
+player_release_all(player* p)
+{
+	int vk;
+
+	for(vk = 0; vk < 256; vk++)
+		if(p->down[vk])
+			player_add(p, (WORD)vk, p->down_scan[vk], p->down_flags[vk] | KEYEVENTF_KEYUP);
+	memset(p->down, 0, sizeof(p->down));
+	p->held = 0;
+	player_flush(p);
+}
+
+/*
+ * Checks that the buffer only holds known opcodes and balanced repeats,
+ * so that the playback loop doesn't have to.
+ */
+static int
+validate_events(const packed_event* events, Py_ssize_t count)
+{
+	Py_ssize_t i;
+	int depth = 0;
+
+	for(i = 0; i < count; i++)
+	{
+		switch(events[i].op)
+		{
+		case OP_KEY_DOWN:
+		case OP_KEY_UP:
+			if(events[i].vk > 0xFF)
+			{
+				PyErr_Format(PyExc_ValueError, "invalid virtual key at event %zd", i);
+				return 0;
+			}
+			break;
+		case OP_UNICODE:
+		case OP_PAUSE:
+			break;
+		case OP_REPEAT:
+			if(++depth > MAX_REPEAT_DEPTH)
+			{
+				PyErr_SetString(PyExc_ValueError, "repeats nested too deeply");
+				return 0;
+			}
+			break;
+		case OP_END:
+			if(--depth < 0)
+			{
+				PyErr_Format(PyExc_ValueError, "unbalanced repeat end at event %zd", i);
+				return 0;
+			}
+			break;
+		default:
+			PyErr_Format(PyExc_ValueError, "unknown opcode %d at event %zd", events[i].op, i);
+			return 0;
+		}
+	}
+	if(depth)
+	{
+		PyErr_SetString(PyExc_ValueError, "unterminated repeat");
+		return 0;
+	}
+	return 1;
+}
+
+static Py_ssize_t
+skip_repeat(const packed_event* events, Py_ssize_t i)
+{
+	int depth = 1;
+
+	while(depth)
+	{
+		i++;
+		if(events[i].op == OP_REPEAT)
+			depth++;
+		else if(events[i].op == OP_END)
+			depth--;
+	}
+	return i;
+}
+
+static char play_docs[] = "\
+play(buffer, pause_ns) -> (sent, waits, total_error_ns, max_error_ns) \n\
+\n\
+Plays packed events (see SendKeys._pack_events) without holding \n\
+the GIL, waiting `pause_ns` nanoseconds between key combinations. \n\
+Returns the number of events sent and how late the waits were. \n\
+";
+
+static PyObject*
+play(PyObject* self, PyObject* args)
+{
+	Py_buffer view;
+	unsigned long long pause_ns = 0;
+	const packed_event* events;
+	Py_ssize_t count, i;
+	repeat_frame stack[MAX_REPEAT_DEPTH];
+	int depth = 0;
+	int pause_due = 0;
+	int interrupted = 0;
+	int unchecked = 0;
+	int last_op = 0;	/* of the last event played, repeats expanded */
+	player* p;
+	PyObject* result;
+
+	if(!PyArg_ParseTuple(args, "y*K", &view, &pause_ns))
+		return NULL;
+
+	if(view.len % sizeof(packed_event))
+	{
+		PyBuffer_Release(&view);
+		PyErr_SetString(PyExc_ValueError, "buffer size is not a multiple of the event size");
+		return NULL;
+	}
+	events = (const packed_event*)view.buf;
+	count = view.len / sizeof(packed_event);
+
+	if(!validate_events(events, count))
+	{
+		PyBuffer_Release(&view);
+		return NULL;
+	}
+
+	p = (player*)PyMem_Calloc(1, sizeof(player));
+	if(p == NULL)
+	{
+		PyBuffer_Release(&view);
+		return PyErr_NoMemory();
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	player_open(p);
+
+	for(i = 0; i < count && !interrupted; i++)
+	{
+		const packed_event* event = &events[i];
+		long long wait = -1;
+
+		/* a run of unicode characters is typed as a whole, even if
+		 * split by an empty repeat */
+		if(event->op == OP_UNICODE && last_op == OP_UNICODE)
+			pause_due = 0;
+
+		switch(event->op)
+		{
+		case OP_KEY_DOWN:
+		case OP_UNICODE:
+			if(pause_due)
+			{
+				pause_due = 0;
+				if(pause_ns)
+				{
+					/* replay this event once the pause is over */
+					wait = (long long)pause_ns;
+					i--;
+					break;
+				}
+			}
+			if(event->op == OP_UNICODE)
+			{
+				player_add(p, 0, (WORD)event->payload, KEYEVENTF_UNICODE);
+				player_add(p, 0, (WORD)event->payload, KEYEVENTF_UNICODE | KEYEVENTF_KEYUP);
+				pause_due = !p->held;
+			}
+			else
+			{
+				DWORD flags = (event->flags & EVENT_EXTENDED) ? KEYEVENTF_EXTENDEDKEY : 0;
+
+				player_add(p, event->vk, event->scan, flags);
+				p->down_scan[event->vk] = event->scan;
+				p->down_flags[event->vk] = flags;
+				if(!p->down[event->vk])
+				{
+					p->down[event->vk] = 1;
+					if(!(event->flags & EVENT_MODIFIER))
+						p->held++;
+				}
+			}
+			break;
+		case OP_KEY_UP:
+			player_add(p, event->vk, event->scan, KEYEVENTF_KEYUP
+				| ((event->flags & EVENT_EXTENDED) ? KEYEVENTF_EXTENDEDKEY : 0));
+			if(p->down[event->vk])
+			{
+				p->down[event->vk] = 0;
+				if(!(event->flags & EVENT_MODIFIER))
+					p->held--;
+			}
+			pause_due = !p->held;
+			break;
+		case OP_PAUSE:
+			wait = (long long)event->payload + (pause_due ? (long long)pause_ns : 0);
+			pause_due = 0;
+			break;
+		case OP_REPEAT:
+			if(event->payload == 0)
+				i = skip_repeat(events, i);
+			else
+			{
+				stack[depth].start = i;
+				stack[depth].remaining = event->payload;
+				depth++;
+			}
+			break;
+		case OP_END:
+			if(--stack[depth - 1].remaining)
+				i = stack[depth - 1].start;
+			else
+				depth--;
+			break;
+		}
+
+		/* unless it is replayed after a pause */
+		if(event->op == OP_PAUSE || (event->op < OP_PAUSE && wait < 0))
+			last_op = event->op;
+
+		if(wait >= 0)
+		{
+			player_flush(p);
+			player_wait(p, wait);
+		}
+
+		/* let Python handle signals such as KeyboardInterrupt, after
+		 * each wait and every batch of events, waits or not */
+		if(wait >= 0 || ++unchecked == BATCH_SIZE)
+		{
+			unchecked = 0;
+			Py_BLOCK_THREADS
+			interrupted = PyErr_CheckSignals();
+			Py_UNBLOCK_THREADS
+		}
+	}
+
+	if(interrupted)
+		player_release_all(p);
+	player_flush(p);
+	player_close(p);
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&view);
+
+	if(interrupted)
+		result = NULL;
+	else
+		result = Py_BuildValue("(KKLL)", p->sent, p->waits, p->total_error, p->max_error);
+	PyMem_Free(p);
+	return result;
+}
+
 static PyMethodDef _sendkeys_methods[] = {
 	{"key_down", key_down, METH_VARARGS, key_down_docs},
 	{"key_up",   key_up,   METH_VARARGS, key_up_docs},
 	{"toggle_numlock", toggle_numlock, METH_VARARGS, toggle_numlock_docs},
+	{"play", play, METH_VARARGS, play_docs},
+#ifndef _WIN32
+	{"stub_events", stub_events, METH_NOARGS, stub_events_docs},
+#endif
 	{NULL, NULL}
 };
 
@@ -0,0 +1,61 @@
+"""
+Measures how long importing `SendKeys` takes in a fresh interpreter, and
+checks that importing it doesn't load ``user32`` nor the ``_sendkeys``
+extension: parsing keys must work on any platform.
+
+    python benchmarks/bench_import.py [-n RUNS]
+"""
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what a parse-only tool does, run in the child interpreter
+CHECK = """\
+import sys
+import SendKeys
+layout = SendKeys.Layout()
+layout.associate_char_to_scancode('a', 0x1E, 0x41)
+SendKeys.compile_keys('a{ENTER}[2]', layout)
+assert SendKeys._user32 is None, 'user32 was loaded'
+assert '_sendkeys' not in sys.modules, '_sendkeys was imported'
+"""
+
+
+def import_time(module) -> (float, float):
+    """
+    Returns the number of seconds it took to import `module` in a new
+    interpreter, with its dependencies and on its own, as reported by
+    ``-X importtime``.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                             cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in process.stderr.splitlines():
+        _, self_time, cumulative, name = (field.strip() for field in line.replace(':', '|', 1).split('|'))
+        if name == module:
+            return int(cumulative) / 1e6, int(self_time) / 1e6
+    raise RuntimeError("'{}' wasn't imported".format(module))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=20, help='number of interpreters to start')
+    args = parser.parse_args()
+
+    subprocess.run([sys.executable, '-c', CHECK], cwd=ROOT, check=True)
+
+    # the first run also writes the bytecode cache
+    import_time('SendKeys')
+    times, self_times = zip(*(import_time('SendKeys') for _ in range(args.runs)))
+    print('import SendKeys: median %.1f ms (%.1f ms without the standard library), '
+          'min %.1f ms over %d runs, no user32 nor _sendkeys loaded'
+          % (statistics.median(times) * 1000, statistics.median(self_times) * 1000,
+             min(times) * 1000, args.runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Checks that the ``_sendkeys`` playback loop plays packed events exactly as
+the Python player does: same events, same number of waits. The extension
+is built from ``setup.py`` against its stub injector, so this runs on
+any platform but Windows.
+
+    python benchmarks/check_native.py [-n PROGRAMS] [--seed SEED]
+
+Besides a few sequences of interest, random programs mixing layout keys,
+Unicode characters, repeats (empty ones included) and pauses are
+checked. Exits with status 1 if any program is played differently.
+"""
+
+import os
+import sys
+import atexit
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import SendKeys
+from fake_user32 import FakeUser32, FAKE_HKL
+
+SEQUENCES = [
+    'Hello{ENTER}',
+    '{SHIFT+a[2]}[3]xyz',
+    '€{a}[0]😀',
+    '€😀é{b}[2]ü',
+    '{CTRL+s}{PAUSE=0}a{ALT+TAB}',
+    '{a}[0]{b}[0]€',
+]
+
+# pieces of the random programs
+TOKENS = ['a', 'B', ' ', 'é', '€', '😀', '{ENTER}', '{a}[0]', '{b}[2]', '{SHIFT+x}',
+          '{CTRL+a[2]}', '{PAUSE=0}', '{RCONTROL+c}', '{ALT}']
+
+
+def build() -> str:
+    """
+    Builds the extension in a temporary directory, which is returned and
+    removed on exit.
+    """
+    build_dir = tempfile.mkdtemp(prefix='sendkeys-')
+    atexit.register(shutil.rmtree, build_dir, True)
+    subprocess.run([sys.executable, 'setup.py', '-q', 'build_ext', '--build-lib', build_dir,
+                    '--build-temp', os.path.join(build_dir, 'temp')],
+                   cwd=ROOT, check=True)
+    return build_dir
+
+
+def play_python(program, pause) -> (list, int):
+    backend = SendKeys.RecordingBackend()
+    report = SendKeys.playkeys(program, pause=pause, backend=backend)
+    return [(event.vk, event.scan, event.flags) for event in backend.events], report.waits
+
+
+def play_native(_sendkeys, program, pause) -> (list, int):
+    _, waits, _, _ = _sendkeys.play(program.events.view, round(pause * 1e9))
+    return _sendkeys.stub_events(), waits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--programs', type=int, default=2000, help='number of random programs')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random programs')
+    args = parser.parse_args()
+
+    if sys.platform == 'win32':
+        parser.exit(2, 'the stub injector is only built outside of Windows\n')
+
+    sys.path.insert(0, build())
+    import _sendkeys
+    _sendkeys.stub_events()
+
+    layout = SendKeys._setup_tables(FakeUser32(), FAKE_HKL)
+    rng = random.Random(args.seed)
+    sequences = SEQUENCES + [''.join(rng.choice(TOKENS) for _ in range(rng.randrange(1, 12)))
+                             for _ in range(args.programs)]
+
+    failures = 0
+    for keys in sequences:
+        program = SendKeys.compile_keys(keys, layout)
+        # a pause short enough not to slow the check down, but taken
+        for pause in (0, 1e-6):
+            python = play_python(program, pause)
+            native = play_native(_sendkeys, program, pause)
+            if python != native:
+                failures += 1
+                print('%r (pause=%g): %d events, %d waits in Python, %d events, %d waits natively'
+                      % (keys, pause, len(python[0]), python[1], len(native[0]), native[1]))
+
+    print('%d programs, %d played differently' % (len(sequences), failures))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
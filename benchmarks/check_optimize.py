@@ -0,0 +1,66 @@
+"""
+Checks that `SendKeys.optimize_keys` doesn't change what gets typed: each
+sequence is played optimized and as parsed into a
+`SendKeys.RecordingBackend`, and their keystrokes must be the same.
+
+    python benchmarks/check_optimize.py [KEYS ...]
+
+Exits with status 1 if any sequence types something else once optimized.
+"""
+
+import os
+import sys
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import SendKeys
+from fake_user32 import FakeUser32, FAKE_HKL
+
+SEQUENCES = [
+    'Hello World',
+    'HELLO WORLD',
+    'a{CTRL}b{SHIFT}',
+    'A{SHIFT}',
+    'A{SHIFT}b',
+    '{SHIFT}{SHIFT}x',
+    '{ALT}{ALT}{SHIFT}a',
+    '{ALT+TAB}{ALT+TAB}',
+    '{CTRL+s}S{CTRL+SHIFT+LEFT}',
+    '{SHIFT+A[2]}[3]ABC',
+    'AB{PAUSE=0.01}{PAUSE=0.02}CD',
+    '{a}[0]XY',
+    'Ab{ENTER}[2]',
+]
+
+
+def keystrokes(program) -> list:
+    backend = SendKeys.RecordingBackend()
+    SendKeys.playkeys(program, pause=0, backend=backend)
+    return backend.keystrokes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sequences', nargs='*', metavar='KEYS',
+                        help='key sequences to check, instead of the built-in ones')
+    args = parser.parse_args()
+
+    layout = SendKeys._setup_tables(FakeUser32(), FAKE_HKL)
+    failures = 0
+    for keys in args.sequences or SEQUENCES:
+        program = SendKeys.compile_keys(keys, layout, with_spaces=True)
+        optimized = SendKeys.compile_keys(keys, layout, with_spaces=True, optimize=True)
+        same = keystrokes(program) == keystrokes(optimized)
+        failures += not same
+        print('%-32r %4d -> %4d events%s'
+              % (keys, len(program), len(optimized), '' if same else '  DIFFERENT KEYSTROKES'))
+
+    if failures:
+        print('\n%d sequence(s) changed by the optimization' % failures)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
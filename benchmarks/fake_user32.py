@@ -0,0 +1,125 @@
+"""
+Stand-in for the ``user32`` functions SendKeys builds its layouts with,
+describing a US QWERTY layout, so that layouts can be built (and thus
+benchmarked) on any platform:
+
+    layout = SendKeys._setup_tables(FakeUser32(), FAKE_HKL)
+"""
+
+FAKE_HKL = 0x04090409
+
+# scan code, virtual key, character, shifted character
+_KEYS = (
+    (0x01, 0x1B, '\x1b', '\x1b'),
+    (0x0E, 0x08, '\b', '\b'),
+    (0x0F, 0x09, '\t', '\t'),
+    (0x1C, 0x0D, '\r', '\r'),
+    (0x39, 0x20, ' ', ' '),
+    (0x0C, 0xBD, '-', '_'),
+    (0x0D, 0xBB, '=', '+'),
+    (0x1A, 0xDB, '[', '{'),
+    (0x1B, 0xDD, ']', '}'),
+    (0x27, 0xBA, ';', ':'),
+    (0x28, 0xDE, "'", '"'),
+    (0x29, 0xC0, '`', '~'),
+    (0x2B, 0xDC, '\\', '|'),
+    (0x33, 0xBC, ',', '<'),
+    (0x34, 0xBE, '.', '>'),
+    (0x35, 0xBF, '/', '?'),
+)
+_KEYS += tuple((0x02 + i, 0x30 + (i + 1) % 10, digit, shifted)
+               for i, (digit, shifted) in enumerate(zip('1234567890', '!@#$%^&*()')))
+_KEYS += tuple((scan, ord(c.upper()), c, c.upper())
+               for first, row in ((0x10, 'qwertyuiop'), (0x1E, 'asdfghjkl'), (0x2C, 'zxcvbnm'))
+               for scan, c in zip(range(first, first + len(row)), row))
+
+# virtual key -> scan code of the keys typing no character
+_OTHER_KEYS = {
+    0x10: 0x2A, 0x11: 0x1D, 0x12: 0x38, 0x14: 0x3A,  # SHIFT, CONTROL, MENU, CAPITAL
+    0x21: 0x49, 0x22: 0x51, 0x23: 0x4F, 0x24: 0x47,  # PRIOR, NEXT, END, HOME
+    0x25: 0x4B, 0x26: 0x48, 0x27: 0x4D, 0x28: 0x50,  # LEFT, UP, RIGHT, DOWN
+    0x2D: 0x52, 0x2E: 0x53,  # INSERT, DELETE
+    0x5B: 0x5B, 0x5C: 0x5C, 0x5D: 0x5D,  # LWIN, RWIN, APPS
+    0x90: 0x45, 0x91: 0x46,  # NUMLOCK, SCROLL
+    0xA0: 0x2A, 0xA1: 0x36, 0xA2: 0x1D, 0xA3: 0x1D, 0xA4: 0x38, 0xA5: 0x38,
+}
+_OTHER_KEYS.update((0x70 + i, 0x3B + i) for i in range(10))  # F1 to F10
+
+_VK_SHIFT = 0x10
+_VK_RMENU = 0xA5
+
+
+class FakeUser32:
+    """
+    The layout probing functions of ``user32`` (``MapVirtualKeyExW``,
+    ``ToUnicodeEx``, ``VkKeyScanExW``, those loading layouts and those
+    giving the foreground window's layout), answering for a US QWERTY
+    layout whatever the ``HKL``. `calls` counts the layout probing
+    calls, `loaded` holds the user's input languages.
+    """
+
+    def __init__(self, hkl=FAKE_HKL):
+        self.hkl = hkl
+        self.calls = 0
+        self.loaded = [hkl]
+        self._vk_to_scan = dict(_OTHER_KEYS)
+        self._scan_to_vk = {}
+        self._scan_to_chars = {}
+        self._chars = {}
+        for scan, vk, c, shifted in _KEYS:
+            self._vk_to_scan[vk] = scan
+            self._scan_to_vk[scan] = vk
+            self._scan_to_chars[scan] = c, shifted
+            self._chars.setdefault(c, (vk, 0))
+            self._chars.setdefault(shifted, (vk, 1))
+        for vk, scan in _OTHER_KEYS.items():
+            self._scan_to_vk.setdefault(scan, vk)
+
+    def MapVirtualKeyExW(self, code, map_type, hkl):
+        self.calls += 1
+        if map_type == 0:  # MAPVK_VK_TO_VSC
+            return self._vk_to_scan.get(code, 0)
+        return self._scan_to_vk.get(code, 0)
+
+    def ToUnicodeEx(self, vk, scan, state, buffer, size, flags, hkl):
+        self.calls += 1
+        chars = self._scan_to_chars.get(scan)
+        if chars is None or state[_VK_RMENU] & 0x80:
+            return 0
+        buffer.value = chars[1] if state[_VK_SHIFT] & 0x80 else chars[0]
+        return 1
+
+    def VkKeyScanExW(self, c, hkl):
+        self.calls += 1
+        try:
+            vk, shift = self._chars[c]
+        except KeyError:
+            return -1
+        return vk | shift << 8
+
+    def LoadKeyboardLayoutW(self, klid, flags):
+        language = int(klid, 16) & 0xFFFF
+        hkl = language << 16 | language
+        if hkl not in self.loaded:
+            self.loaded.append(hkl)
+        return hkl
+
+    def UnloadKeyboardLayout(self, hkl):
+        if hkl not in self.loaded:
+            return 0
+        self.loaded.remove(hkl)
+        return 1
+
+    def GetKeyboardLayoutList(self, size, layouts):
+        for i, hkl in enumerate(self.loaded[:size]):
+            layouts[i] = hkl
+        return len(self.loaded) if not size else min(size, len(self.loaded))
+
+    def GetForegroundWindow(self):
+        return 1
+
+    def GetWindowThreadProcessId(self, window, process_id):
+        return 1
+
+    def GetKeyboardLayout(self, thread_id):
+        return self.hkl
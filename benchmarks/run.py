@@ -0,0 +1,278 @@
+"""
+Benchmarks of the parser, the layout build and the playback of SendKeys.
+
+They run on any platform: layouts are built from a fake ``user32`` (see
+`fake_user32`) and keys are played into a `SendKeys.RecordingBackend`.
+
+    python benchmarks/run.py [-n RUNS] [-o RESULTS.json] [--compare BASELINE.json]
+
+``--compare`` flags the benchmarks that got slower than in a previous
+``-o`` output by more than ``--threshold``, and exits with status 1 if
+any did. The import time is measured apart, by `bench_import`.
+
+The memory allocated per event sent to the recording backend is reported
+as well, through the pooled INPUT buffers of the player and through an
+INPUT structure per event (`Backend.send_all`), as measured with
+`tracemalloc` and `sys.getallocatedblocks`.
+"""
+
+import gc
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import statistics
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import SendKeys
+from fake_user32 import FakeUser32, FAKE_HKL
+
+# name -> (function(layout) returning the number of units processed, unit)
+BENCHMARKS = {}
+
+
+def benchmark(name, unit):
+    def register(function):
+        BENCHMARKS[name] = function, unit
+        return function
+    return register
+
+
+def _text(size, alphabet='abcdefghijklmnopqrstuvwxyzABCDEFGHIJ ,.;!?0123456789'):
+    rng = random.Random(size)
+    return ''.join(rng.choice(alphabet) for _ in range(size))
+
+
+PLAIN_TEXT = _text(100 * 1024)
+MACRO = '{CTRL+s}{ALT+TAB}{SHIFT+a+b}{ENTER}{F5}{CTRL+SHIFT+LEFT}{PAUSE=0}{HOME}x' * 2000
+MULTIPLIERS = '{a}[10000]{SHIFT+b[10]}[1000]{CTRL+c}[5000]'
+LAYOUT_IDS = ['00000409', '00000407', '0000040C', '00000410', '00000C0A', '00000816', '00000415', '00000419']
+
+
+@benchmark('str2keys_plain', 'events')
+def bench_str2keys_plain(layout):
+    return len(SendKeys.str2keys(PLAIN_TEXT, layout, with_spaces=True))
+
+
+@benchmark('str2keys_macro', 'events')
+def bench_str2keys_macro(layout):
+    return len(SendKeys.str2keys(MACRO, layout))
+
+
+@benchmark('str2keys_multipliers', 'events')
+def bench_str2keys_multipliers(layout):
+    return len(SendKeys.str2keys(MULTIPLIERS, layout))
+
+
+@benchmark('setup_tables', 'layouts')
+def bench_setup_tables(layout):
+    SendKeys._setup_tables(FakeUser32(), FAKE_HKL)
+    return 1
+
+
+@benchmark('setup_tables_lazy', 'layouts')
+def bench_setup_tables_lazy(layout):
+    # a lazy layout, until it can type the text benchmarks
+    lazy = SendKeys._setup_tables(FakeUser32(), FAKE_HKL, lazy=True)
+    SendKeys.str2keys(PLAIN_TEXT[:4096], lazy, with_spaces=True)
+    return 1
+
+
+@benchmark('registry_warm', 'layouts')
+def bench_registry_warm(layout):
+    registry = SendKeys.LayoutRegistry(FakeUser32(), SendKeys.LayoutCache())
+    return len(registry.warm(LAYOUT_IDS).layouts)
+
+
+@benchmark('playkeys', 'events')
+def bench_playkeys(layout):
+    program = SendKeys.KeyProgram(PLAIN_TEXT, SendKeys.str2keys(PLAIN_TEXT, layout, with_spaces=True), layout)
+    backend = SendKeys.RecordingBackend()
+    # pack the program beforehand, only the playback is timed
+    program.events
+    start = time.perf_counter()
+    SendKeys.playkeys(program, pause=0, backend=backend)
+    return sum(backend.batch_sizes), time.perf_counter() - start
+
+
+@benchmark('type_text', 'events')
+def bench_type_text(layout):
+    backend = SendKeys.RecordingBackend()
+    backend.type_text(PLAIN_TEXT, layout)
+    return sum(backend.batch_sizes)
+
+
+def _send_pooled(backend, events):
+    buffer = SendKeys._acquire_buffer()
+    try:
+        for vk, scan, flags in events:
+            buffer.add_key(vk, scan, flags)
+            if buffer.count == SendKeys.MAX_BATCH_SIZE:
+                buffer.flush(backend)
+        buffer.flush(backend)
+    finally:
+        SendKeys._release_buffer(buffer)
+
+
+def _send_unpooled(backend, events):
+    for start in range(0, len(events), SendKeys.MAX_BATCH_SIZE):
+        backend.send_all([SendKeys._key_input(vk, scan, flags)
+                          for vk, scan, flags in events[start:start + SendKeys.MAX_BATCH_SIZE]])
+
+
+class _AllocationProbe(SendKeys.RecordingBackend):
+    """
+    Records the memory blocks and bytes allocated since `reset` that are
+    alive when each batch is sent: those made to fill the batch, the
+    batches themselves being dropped once sent.
+    """
+
+    __slots__ = (
+        "_blocks",
+        "_bytes",
+        "blocks",
+        "bytes",
+        "events"
+    )
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        self.blocks = self.bytes = self.events = 0
+        self._blocks = sys.getallocatedblocks()
+        self._bytes = tracemalloc.get_traced_memory()[0]
+
+    def send(self, inputs, count):
+        self.blocks += sys.getallocatedblocks() - self._blocks
+        self.bytes += tracemalloc.get_traced_memory()[0] - self._bytes
+        self.events += count
+        super().send(inputs, count)
+        self.clear()
+
+
+def allocations(send, events) -> dict:
+    """
+    Sends `events` (``(vk, scan, flags)``) to a `SendKeys.RecordingBackend`
+    with `send`, and returns the memory blocks and bytes per event that
+    were allocated for their batch and are alive when it is sent.
+    """
+    probe = _AllocationProbe()
+    # collections would free memory allocated before `reset` meanwhile
+    gc.disable()
+    tracemalloc.start()
+    try:
+        # warm up the pool and the caches
+        send(probe, events)
+        probe.reset()
+        send(probe, events)
+    finally:
+        tracemalloc.stop()
+        gc.enable()
+    return {'blocks_per_event': probe.blocks / probe.events,
+            'bytes_per_event': probe.bytes / probe.events}
+
+
+def run(name, runs, layout) -> dict:
+    """
+    Runs a benchmark `runs` times, returns the best and median times and
+    the best rate.
+    """
+    function, unit = BENCHMARKS[name]
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = function(layout)
+        elapsed = time.perf_counter() - start
+        # benchmarks with a setup time only report the part they time
+        if isinstance(result, tuple):
+            result, elapsed = result
+        times.append(elapsed)
+    best = min(times)
+    return {'seconds': best,
+            'median': statistics.median(times),
+            'runs': runs,
+            'units': result,
+            'unit': unit,
+            'rate': result / best if best else 0.0}
+
+
+def compare(results, baseline, threshold) -> list:
+    """
+    Prints how each benchmark compares to `baseline`, returns the names
+    of those that got slower by more than `threshold` (a fraction).
+    """
+    regressions = []
+    print('\n%-24s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'change'))
+    for name, result in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            print('%-24s %12s %10.2fms %8s' % (name, '-', result['seconds'] * 1000, 'new'))
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-24s %10.2fms %10.2fms %+7.1f%%%s'
+              % (name, before['seconds'] * 1000, result['seconds'] * 1000, change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5, help='runs of each benchmark, the best one counts')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare to the results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown from the baseline reported as a regression (default: 0.10)')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run, all by default: ' + ', '.join(BENCHMARKS))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: '{}'".format(name))
+
+    layout = SendKeys._setup_tables(FakeUser32(), FAKE_HKL)
+    results = {'python': platform.python_version(),
+               'implementation': platform.python_implementation(),
+               'platform': platform.platform(),
+               'benchmarks': {}}
+
+    for name in args.benchmarks or BENCHMARKS:
+        result = results['benchmarks'][name] = run(name, args.runs, layout)
+        print('%-24s %10.2fms  (median %.2fms)  %12.0f %s/s'
+              % (name, result['seconds'] * 1000, result['median'] * 1000, result['rate'], result['unit']))
+
+    backend = SendKeys.RecordingBackend()
+    SendKeys.playkeys(SendKeys.str2keys(PLAIN_TEXT, layout, with_spaces=True), layout, pause=0, backend=backend)
+    events = [(event.vk, event.scan, event.flags) for event in backend.events]
+    results['allocations'] = {'pooled': allocations(_send_pooled, events),
+                              'unpooled': allocations(_send_unpooled, events)}
+    print()
+    for name, result in results['allocations'].items():
+        print('%-24s %8.2f blocks/event %8.1f bytes/event'
+              % ('send_' + name, result['blocks_per_event'], result['bytes_per_event']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,7 +24,9 @@ setup(
     license='Python License',
     py_modules=['SendKeys'],
     ext_modules=[
-        Extension("_sendkeys", ["_sendkeys.c"], libraries=['user32', 'kernel32']),
+        # elsewhere, the extension builds against a stub injector (for tests)
+        Extension("_sendkeys", ["_sendkeys.c"],
+                  libraries=['user32', 'kernel32', 'winmm'] if sys.platform == 'win32' else []),
     ],
     data_files=[
         ('.', ['README.md']),